@@ -0,0 +1,208 @@
+## Indexed view of the appendix datafiles used by batch_curation, zipped or
+## given as paths on disk
+
+# -------------------------------------------- file os and other general lib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from collections import OrderedDict
+# -------------------------------------------- logging
+import logging
+
+# default size cap of the extracted members kept on disk, in bytes
+DEFAULT_CACHE_SIZE = 1024*1024*1024
+
+class AppendixIndex():
+    def __init__(self, zipped_datafiles, cache_size=DEFAULT_CACHE_SIZE,
+        cache_root=None):
+        '''
+        Index the members of the zipped datafiles once and extract members
+        only when they are requested. Extracted members are kept in a least
+        recently used cache capped at cache_size bytes. extract and copy may
+        be called from several threads.
+
+        Input:
+        :param zipped_datafiles: file name of the zipped datafiles. *.zip
+        :type zipped_datafiles: str
+
+        :param cache_size: size cap of the extracted members on disk, in bytes.
+            The most recently requested member is always kept.
+        :type cache_size: int
+
+        :param cache_root: directory in which the cache directory is created.
+            Default to the system temporary directory
+        :type cache_root: str or NoneType
+        '''
+        self.zf = zipfile.ZipFile(zipped_datafiles)
+        # member name -> ZipInfo, folders are not appendix files
+        self.members = {info.filename: info for info in self.zf.infolist()
+            if not info.is_dir()}
+        self.cache_size = cache_size
+        self.cache_root = cache_root
+        self.cache_dir = None
+        # member name -> (extracted path, bytes on disk), in least recently
+        # used order
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # member name -> event set once the member is extracted by a thread
+        self.pending = {}
+        # member name -> number of copies in progress, never evicted
+        self.pins = {}
+
+    def __contains__(self, name):
+        return isinstance(name, str) and name in self.members
+
+    def getinfo(self, name):
+        return self.members[name]
+
+    def open(self, name):
+        return self.zf.open(self.members[name])
+
+    def file_id(self, name):
+        # hashable id of the content of a member
+        info = self.members[name]
+        return (self.zf.filename, name, info.CRC, info.file_size)
+
+    def extract(self, name, pin=False):
+        '''
+        Return the path of the extracted member. The path stays valid until
+        the next call of extract evicts it, or until unpin if pinned.
+        '''
+        while True:
+            with self.lock:
+                if name in self.cache:
+                    self.hits += 1
+                    self.cache.move_to_end(name)
+                    if pin:
+                        self.pins[name] = self.pins.get(name, 0) + 1
+                    return self.cache[name][0]
+                event = self.pending.get(name)
+                if event is None:
+                    # this thread extracts the member
+                    self.pending[name] = threading.Event()
+                    self.misses += 1
+                    if self.cache_dir is None:
+                        self.cache_dir = tempfile.mkdtemp(
+                            prefix='zipped_datafiles_', dir=self.cache_root)
+                    break
+            # another thread is extracting the member
+            event.wait()
+        path = None
+        try:
+            path = self.zf.extract(self.members[name], self.cache_dir)
+        finally:
+            with self.lock:
+                event = self.pending.pop(name)
+                if path is not None:
+                    self.cache[name] = (path, self.members[name].file_size)
+                    self.cache_bytes += self.members[name].file_size
+                    if pin:
+                        self.pins[name] = self.pins.get(name, 0) + 1
+                    self.evict()
+                event.set()
+        return path
+
+    def unpin(self, name):
+        with self.lock:
+            self.pins[name] -= 1
+            if not self.pins[name]:
+                del self.pins[name]
+
+    def copy(self, name, dest):
+        '''
+        Copy the member to dest, extracting it if needed.
+
+        Output:
+        :return: seconds spent extracting and copying
+        :rtype: tuple(float, float)
+        '''
+        start = time.perf_counter()
+        path = self.extract(name, pin=True)
+        extracted = time.perf_counter()
+        try:
+            shutil.copy(path, dest)
+        finally:
+            self.unpin(name)
+        return extracted - start, time.perf_counter() - extracted
+
+    def evict(self):
+        # drop least recently used members, never the newest one nor members
+        # being copied, called with the lock held
+        for name in list(self.cache):
+            if self.cache_bytes <= self.cache_size or len(self.cache) <= 1:
+                break
+            if name in self.pins:
+                continue
+            path, size = self.cache.pop(name)
+            os.remove(path)
+            self.cache_bytes -= size
+            logging.info(f'{name} evicted from the appendix cache.')
+
+    def close(self):
+        self.zf.close()
+        if self.cache_dir is not None:
+            for path, size in self.cache.values():
+                os.remove(path)
+            self.cache.clear()
+            self.cache_bytes = 0
+            # members in sub folders leave empty folders behind
+            for root, dirs, files in os.walk(self.cache_dir, topdown=False):
+                os.rmdir(root)
+            self.cache_dir = None
+
+class DirectoryAppendix():
+    def __init__(self, files):
+        '''
+        Appendix datafiles read straight from their location on disk, with the
+        interface of AppendixIndex. Nothing is extracted or copied.
+
+        Input:
+        :param files: file name in the sample folders -> path of the file
+        :type files: dict
+        '''
+        self.files = {name: os.path.abspath(path) for name,path in files.items()}
+        # ZipInfo of the files, created when first requested
+        self.members = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, name):
+        return isinstance(name, str) and name in self.files
+
+    def getinfo(self, name):
+        if name not in self.members:
+            info = zipfile.ZipInfo.from_file(self.files[name], name)
+            # the CRC identifies the content in the manifest
+            crc = 0
+            with open(self.files[name], 'rb') as f:
+                for chunk in iter(lambda: f.read(1024*1024), b''):
+                    crc = zlib.crc32(chunk, crc)
+            info.CRC = crc
+            self.members[name] = info
+        return self.members[name]
+
+    def open(self, name):
+        return open(self.files[name], 'rb')
+
+    def file_id(self, name):
+        stat = os.stat(self.files[name])
+        return (self.files[name], stat.st_size, stat.st_mtime_ns)
+
+    def extract(self, name, pin=False):
+        # the file is already on disk
+        return self.files[name]
+
+    def copy(self, name, dest):
+        start = time.perf_counter()
+        shutil.copy(self.files[name], dest)
+        return 0.0, time.perf_counter() - start
+
+    def close(self):
+        self.members = {}
@@ -2,24 +2,44 @@
 
 # -------------------------------------------- file os and other general lib
 import os
-import shutil
+import io
+import time
+import pickle
+import cProfile
 import tempfile
+from collections import deque
+from functools import partial
+from itertools import tee, count
 from glob import glob
-from tqdm import tqdm
+# -------------------------------------------- for parallel processing
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 # -------------------------------------------- for data I/O
-import openpyxl
-import pandas as pd
-import zipfile
-from inp_parser.inp_parser import Parser
+# openpyxl, numpy and tqdm are imported once needed, see load_engines
+from mapping_reader import MappingReader, FrameReader
+from inp_parser.version import PARSER_VERSION
+from inp_parser.cache import ParseCache
+from output_archive import ShardedOutput, STORE_EXTENSIONS
+from appendix_index import AppendixIndex, DirectoryAppendix
+from manifest import Manifest, PreviousOutput, file_digest
+from output_verify import expected_cells, check_sample, write_report
+from run_profile import RunProfile
 # -------------------------------------------- for command line arguments
 import argparse
 import sys
 # -------------------------------------------- logging
 import logging
+import logging.handlers
 
 class batch_curation():
     def __init__(self, base_dir, master_template, mapping_tabular,
-            zipped_datafiles, parse_inp, output_zip=None):
+            zipped_datafiles, parse_inp, output_zip=None, workers=1,
+            stream_output=False, cache_size_mb=1024, inp_cache_dir=None,
+            inp_cache_size_mb=512, incremental=False, profile=False,
+            cprofile_sample=None, engine='openpyxl', shards=1,
+            shard_samples=None, shard_size_mb=None, compresslevel=None,
+            store_ext=STORE_EXTENSIONS, io_threads=4, inp_cache=None,
+            templates=None, verify=False, worker_pool=None):
         '''
         Input:
         :param base_dir: base directory of the master template, mapping tabular 
@@ -31,11 +51,13 @@ class batch_curation():
         :type master_template: str
 
         :param mapping_tabular: file name of the mapping tabular file.
-            *.xlsx/*.csv/*.tsv
-        :type mapping_tabular: str
+            *.xlsx/*.csv/*.tsv, or the mapping itself, e.g. as prepared by
+            bc_prep.prepare_batch_curation
+        :type mapping_tabular: str or pandas.DataFrame
         
-        :param zipped_datafiles: file name of the zipped datafiles. *.zip
-        :type zipped_datafiles: str
+        :param zipped_datafiles: file name of the zipped datafiles. *.zip, or
+            file name in the sample folders -> path of the datafile on disk
+        :type zipped_datafiles: str or dict
 
         :param parse_inp: call inp_parser and modify/overwrite template if True
         :type parse_inp: bool
@@ -43,6 +65,93 @@ class batch_curation():
         :param output_zip: file name of the constructed zip file for batch
             curation. Default to {base_dir}/batch_template_output.zip
         :type output_zip: str or NoneType
+
+        :param workers: number of worker processes used to generate the
+            samples. Default to 1, i.e. serial processing in this process
+        :type workers: int
+
+        :param stream_output: write the appendix files and the filled master
+            templates straight into the output zip without staging folders
+        :type stream_output: bool
+
+        :param cache_size_mb: size cap of the appendix datafiles extracted from
+            the zipped datafiles and kept on disk, in MB. Only members referenced
+            by the mapping are extracted.
+        :type cache_size_mb: int
+
+        :param inp_cache_dir: directory of the on-disk cache of inp_parser
+            outputs shared among runs. Parser outputs are only cached in
+            memory if None
+        :type inp_cache_dir: str or NoneType
+
+        :param inp_cache_size_mb: size cap of the on-disk inp_parser cache,
+            in MB
+        :type inp_cache_size_mb: int
+
+        :param incremental: only generate the samples whose mapping row, master
+            template or appendix files changed since the previous run, as
+            recorded in {output_zip}.manifest.json. The other samples are
+            copied from the previous output zip
+        :type incremental: bool
+
+        :param profile: time every stage of the run and save the timings, bytes
+            moved and cache counters per sample and for the whole run as
+            {output_zip}.profile.json
+        :type profile: bool
+
+        :param cprofile_sample: id of a sample to run under cProfile, the stats
+            are saved as {output_zip}.{sample id}.prof
+        :type cprofile_sample: str or NoneType
+
+        :param engine: templating engine, 'openpyxl' loads and saves the
+            workbook with openpyxl, 'xml' rewrites the changed cells in the
+            sheet XML of the master template
+        :type engine: str
+
+        :param shards: number of output zip files written concurrently, the
+            samples are distributed round robin. Output zip files are named
+            {output_zip}_part000.zip, ... if sharded
+        :type shards: int
+
+        :param shard_samples: maximum number of samples per output zip file
+        :type shard_samples: int or NoneType
+
+        :param shard_size_mb: maximum uncompressed size per output zip file,
+            in MB, samples are never split
+        :type shard_size_mb: float or NoneType
+
+        :param compresslevel: deflate level 0-9 of the output zip files
+        :type compresslevel: int or NoneType
+
+        :param store_ext: extensions of the files stored without compression in
+            the output zip files, e.g. already compressed .mat and images
+        :type store_ext: set
+
+        :param io_threads: number of threads per process extracting and
+            copying the appendix datafiles, the files of the next sample are
+            staged while the template of the current sample is filled
+        :type io_threads: int
+
+        :param inp_cache: inp_parser cache shared with other runs in this
+            process, replaces inp_cache_dir and inp_cache_size_mb
+        :type inp_cache: inp_parser.cache.ParseCache or NoneType
+
+        :param templates: compiled master templates shared with other runs in
+            this process, (engine, path) -> (digest, template). A template is
+            compiled again if its file changed
+        :type templates: dict or NoneType
+
+        :param verify: check every sample of the output zip files against the
+            mapping, the placeholders of the master template and the parser
+            outputs after the run, using the worker processes. The parser
+            outputs recorded in the manifest are used, the inp files are not
+            parsed again. The result of every sample is saved as
+            {output_zip}.verify.csv
+        :type verify: bool
+
+        :param worker_pool: worker processes kept between runs, used instead
+            of starting a process pool if workers > 1, see WorkerPool
+        :type worker_pool: WorkerPool or NoneType
         '''
         logging.basicConfig(level=logging.INFO, 
                             filename=f'{base_dir}/batch_curation.log',
@@ -50,11 +159,42 @@ class batch_curation():
                             datefmt='%d-%b-%y %H:%M:%S')
         # save parse_inp option
         self.parse_inp = parse_inp
+        self.workers = max(1, workers or 1)
+        self.stream_output = stream_output
+        self.cache_size = int(cache_size_mb*1024*1024)
+        self.incremental = incremental
+        self.verify = verify
+        self.verify_failures = None
+        self.profile = RunProfile(enabled=profile)
+        self.cprofile_sample = cprofile_sample
+        if engine not in load_engines():
+            logging.error(f'Unknown templating engine {engine}.')
+            raise Exception(f'Unknown templating engine {engine}, use one of \
+{", ".join(load_engines())}.')
+        self.engine = engine
+        self.shards = max(1, shards or 1)
+        self.shard_samples = shard_samples
+        self.shard_size = int(shard_size_mb*1024*1024) if shard_size_mb else None
+        self.compresslevel = compresslevel
+        self.store_ext = set(store_ext)
+        self.io_threads = max(1, io_threads or 1)
+        # samples sharing an inp file, or runs after a template change, reuse
+        # the parser output
+        self.inp_cache = inp_cache if inp_cache is not None else ParseCache(
+            inp_cache_dir, max_bytes=int(inp_cache_size_mb*1024*1024))
+        self.templates = templates if templates is not None else {}
+        self.worker_pool = worker_pool
         self.base_dir_abspath = os.path.abspath(base_dir)
         self.master_template_abspath = os.path.abspath(os.path.join(base_dir,
             master_template))
-        self.zipped_datafiles_abspath = os.path.abspath(os.path.join(base_dir,
-            zipped_datafiles))
+        if isinstance(zipped_datafiles, dict):
+            # datafiles are read from disk, there is no zip
+            self.appendix_files = zipped_datafiles
+            self.zipped_datafiles_abspath = None
+        else:
+            self.appendix_files = None
+            self.zipped_datafiles_abspath = os.path.abspath(os.path.join(
+                base_dir, zipped_datafiles))
         # default name of the generated master template in the sample folders
         self.master_template_name = 'master_template.xlsx'
         self.output_zip = os.path.join(self.base_dir_abspath,
@@ -62,121 +202,725 @@ class batch_curation():
         # trim .zip
         if self.output_zip[-4:] == '.zip':
            self.output_zip = self.output_zip[:-4]
-        # load mapping
-        self.df = self.read_mapping(self.base_dir_abspath, mapping_tabular)
+        # open the mapping, rows are read one at a time during the run
+        with self.profile.stage('mapping_read'):
+            self.mapping = self.read_mapping(self.base_dir_abspath,
+                mapping_tabular)
         # run
         self.run()
 
     def read_mapping(self, base_dir, mapping_tabular):
-        ## Read sample-variable mapping
-        file_ext = os.path.splitext(mapping_tabular)[1].lower()
-        # Excel file
-        if file_ext == '.xlsx':
-            df = pd.read_excel(os.path.join(base_dir,mapping_tabular))
-        # csv file
-        elif file_ext == '.csv':
-            df = pd.read_csv(os.path.join(base_dir,mapping_tabular))
-        # tsv file
-        elif file_ext == '.tsv':
-            df = pd.read_csv(os.path.join(base_dir,mapping_tabular),sep='\t')
-        else:
-            logging.error('The mapping file must be a .xlsx/.csv/.tsv file.')
-            raise Exception('The mapping file must be a .xlsx/.csv/.tsv file.')
-        return df
+        ## Read sample-variable mapping, .xlsx/.csv/.tsv or a DataFrame
+        if not isinstance(mapping_tabular, str):
+            return FrameReader(mapping_tabular)
+        return MappingReader(os.path.join(base_dir,mapping_tabular))
+
+    def load_template(self, digest):
+        # reuse the template compiled by a previous run unless it changed
+        key = (self.engine, self.master_template_abspath)
+        cached = self.templates.get(key)
+        if cached is not None and cached[0] == digest:
+            logging.info('Reusing the compiled master template.')
+            return cached[1]
+        template = load_engines()[self.engine](self.master_template_abspath)
+        self.templates[key] = (digest, template)
+        return template
+
+    def check_placeholders(self):
+        # fail before any work if the template uses placeholders that are not
+        # columns of the mapping
+        missing = self.template.placeholders - set(self.mapping.columns)
+        if missing:
+            missing = ', '.join(sorted(missing))
+            logging.error(f'Placeholders missing from the mapping: {missing}.')
+            raise Exception(f'Placeholders used in the master template are \
+missing from the mapping: {missing}.')
 
     def run(self):
-        # create temporary directory
-        with tempfile.TemporaryDirectory() as td:
+        start = time.perf_counter()
+        template_digest = file_digest(self.master_template_abspath)
+        # workers of a WorkerPool look up their compiled template by digest
+        self.template_digest = template_digest
+        # load and index the master template once for all samples
+        with self.profile.stage('template_load'):
+            self.template = self.load_template(template_digest)
+        self.check_placeholders()
+        self.nsamples = 0
+        # record the inputs of every sample for incremental rebuilds
+        self.manifest = Manifest(self.output_zip + '.manifest.json',
+            template_digest,
+            {'parse_inp': self.parse_inp, 'parser_version': PARSER_VERSION,
+            'master_template_name': self.master_template_name,
+            'engine': self.engine})
+        self.previous_output = PreviousOutput()
+        try:
+            if self.stream_output:
+                self.run_stream()
+            else:
+                self.run_folders()
+        finally:
+            self.previous_output.close()
+            self.close_io_pool()
+        # shards of a previous run that were not written again
+        self.output.remove_stale()
+        self.manifest.save()
+        if self.profile.enabled:
+            self.profile.save(self.output_zip + '.profile.json', {
+                'samples': self.nsamples, 'workers': self.workers,
+                'stream_output': self.stream_output,
+                'parse_inp': self.parse_inp, 'incremental': self.incremental,
+                'wall_seconds': time.perf_counter() - start})
+        if self.verify:
+            self.verify_output()
+        print(self.output_zip)
+
+    def verify_output(self):
+        start = time.perf_counter()
+        # output zip files written by this run, carried samples included
+        self.verify_archives = [writer.path for writer in self.output.writers]
+        # inp_parser outputs recorded by the run, sent along to the workers
+        self.verify_parser_outs = self.manifest.parser_outs()
+        try:
+            results = self.map_samples('verify_sample', iter(self.mapping))
+            self.verify_failures = write_report(self.output_zip + '.verify.csv',
+                progress(results, total=self.nsamples))
+            results.close()
+        finally:
+            self.close_appendix()
+            if getattr(self, 'verify_index', None) is not None:
+                self.verify_index.close()
+                self.verify_index = None
+        if self.verify_failures:
+            print(f'Warning: {self.verify_failures} of {self.nsamples} samples \
+failed verification, see {self.output_zip}.verify.csv.')
+            logging.warning(f'{self.verify_failures} of {self.nsamples} \
+samples failed verification.')
+        logging.info(f'{self.nsamples} samples verified in \
+{time.perf_counter()-start:.1f} s.')
+
+    def verify_sample(self, sample_mapping):
+        '''
+        Check the sample folder in the output zip files: the appendix files
+        are present, the cells of the master template hold the values of the
+        mapping and of the parser outputs, and no placeholder is left.
+
+        Output:
+        :return: sample id, output zip file name, issues found and number of
+            cells checked
+        :rtype: tuple(str, str, list, int)
+        '''
+        sample_id = sample_mapping[0]
+        files = self.sample_files(sample_mapping)
+        # the parser outputs recorded by the run, carried samples of a manifest
+        # without them are parsed again
+        parser_out = self.verify_parser_outs.get(str(sample_id))
+        if parser_out is None:
+            parser_out = self.parse_sample(sample_id, [file for file in files
+                if os.path.splitext(file)[1].lower() == '.inp'])
+        expected = expected_cells(self.template, sample_mapping, parser_out)
+        # every process indexes the output zip files once
+        if getattr(self, 'verify_index', None) is None:
+            self.verify_index = PreviousOutput()
+        for archive in self.verify_archives:
+            zf, members = self.verify_index.members(archive, sample_id)
+            if members:
+                issues, checked = check_sample(sample_id, zf, members,
+                    self.master_template_name, files, expected,
+                    self.template.placeholders)
+                return sample_id, os.path.basename(archive), issues, checked
+        return sample_id, None, ['sample missing from the output'], 0
+
+    def open_output(self):
+        self.output = ShardedOutput(self.output_zip, shards=self.shards,
+            shard_samples=self.shard_samples, shard_size=self.shard_size,
+            compresslevel=self.compresslevel, store_ext=self.store_ext)
+        return self.output
+
+    def close_output(self):
+        # time spent by the writer threads, may exceed the wall time
+        self.profile.add('final_archive',
+            sum(writer.seconds for writer in self.output.writers),
+            sum(writer.bytes for writer in self.output.writers))
+        logging.info(f'{self.nsamples} samples written into \
+{len(self.output.writers)} output zip files.')
+
+    def run_folders(self):
+        # create temporary directories for the sample folders and for the
+        # extracted data files, which must not end up in the output zip
+        with tempfile.TemporaryDirectory() as td, \
+            tempfile.TemporaryDirectory() as cache_td:
             self.tempdir = td
-            # extract zip files
-            self.extracted_datafiles_abspath = os.path.join(self.tempdir,
-                'zipped_datafiles')
-            os.mkdir(self.extracted_datafiles_abspath)
-            # move into the temporary directory
-            os.chdir(self.tempdir)
-
-            # extract data files
-            appendix = zipfile.ZipFile(self.zipped_datafiles_abspath)
-            appendix.extractall(self.extracted_datafiles_abspath)
+            self.cache_root = cache_td
+            # index the data files, members are only extracted when referenced
+            self.open_appendix()
+            # the mapping is read once, the workers stay a bounded number of
+            # samples ahead of this loop
+            plan, changed = tee(self.plan_samples())
             # for each sample, call run_sample to create the sample folder and move
             # corresponding files into it and modify as needed
-            for idx,sample in tqdm(self.df.iterrows(), total=self.df.shape[0]):
-                self.run_sample(sample)
-            # remove extracted data files
-            shutil.rmtree(self.extracted_datafiles_abspath)
-            # zip the files in the temporary folder into a zip file self.output_zip
-            shutil.make_archive(self.output_zip, 'zip', self.tempdir)
-            print(self.output_zip)
+            results = self.map_samples('run_sample',
+                (sample for sample,carried in changed if carried is None))
+            # each sample folder is zipped by the writer thread of its shard as
+            # soon as it is complete
+            with self.open_output() as output:
+                for sample, carried in progress(plan,
+                    total=self.mapping.nrows_hint()):
+                    if carried is None:
+                        parser_out = next(results)
+                        if self.parse_inp:
+                            self.manifest.set_parser_out(sample[0], parser_out)
+                    else:
+                        # unchanged sample, copy the folder of the previous output
+                        zf, members = carried
+                        with self.profile.stage('carry_copy',
+                            sum(info.file_size for info in members)):
+                            for info in members:
+                                zf.extract(info, self.tempdir)
+                    folder = os.path.join(self.tempdir, sample[0])
+                    archive = output.add_sample(folder_size(folder),
+                        [partial(write_folder, self.tempdir, sample[0])])
+                    self.manifest.set_archive(sample[0], archive)
+                # shut down the worker processes
+                results.close()
+                # remove extracted data files
+                self.close_appendix()
+                self.previous_output.close()
+            self.close_output()
+            self.tempdir = self.cache_root = None
+
+    def run_stream(self):
+        # no staging folders, appendix members are copied from the input zip
+        # into the output zip and the workbooks are saved in memory
+        appendix = self.open_appendix()
+        try:
+            plan, changed = tee(self.plan_samples())
+            results = self.map_samples('build_sample',
+                (sample for sample,carried in changed if carried is None))
+            # samples are written in the order of the mapping by the writer
+            # threads of the shards
+            with self.open_output() as output:
+                for sample, carried in progress(plan,
+                    total=self.mapping.nrows_hint()):
+                    if carried is not None:
+                        # unchanged sample, copy the folder of the previous output
+                        zf, members = carried
+                        archive = output.add_sample(
+                            sum(info.file_size for info in members),
+                            [partial(write_members, zf, members)])
+                    else:
+                        sample_id, files, workbook, parser_out = next(results)
+                        if self.parse_inp:
+                            self.manifest.set_parser_out(sample_id, parser_out)
+                        archive = output.add_sample(len(workbook) +
+                            sum(appendix.getinfo(file).file_size
+                            for file in files),
+                            [partial(write_sample, appendix, sample_id, files,
+                            f'{sample_id}/{self.master_template_name}',
+                            workbook)])
+                    self.manifest.set_archive(sample[0], archive)
+                # shut down the worker processes
+                results.close()
+            self.close_output()
+        finally:
+            self.close_appendix()
+
+    def plan_samples(self):
+        '''
+        Record every sample in the manifest and decide whether it can be
+        carried over from the previous output.
+
+        Output:
+        :return: (sample_mapping, carried) in the order of the mapping, carried
+            is the previous output zip and the members of the sample folder,
+            or None if the sample has to be generated
+        :rtype: generator
+        '''
+        appendix = self.open_appendix()
+        # datafiles on disk are checked and hashed on first use, overlap the
+        # latency of the files of a sample
+        getinfo = partial(self.open_io_pool().map, appendix.getinfo) \
+            if isinstance(appendix, DirectoryAppendix) else partial(map,
+            appendix.getinfo)
+        n_carried = 0
+        for sample in self.mapping:
+            entry = self.manifest.entry(sample,
+                list(getinfo(self.sample_files(sample))))
+            carried = None
+            archive = self.manifest.carry_source(sample[0], entry) \
+                if self.incremental else None
+            if archive is not None:
+                zf, members = self.previous_output.members(archive, sample[0])
+                # the previous sample folder must hold the master template
+                if f'{sample[0]}/{self.master_template_name}' in \
+                {info.filename for info in members}:
+                    carried = (zf, members)
+            self.manifest.add(sample[0], entry, self.output_zip + '.zip')
+            if carried is not None and self.parse_inp:
+                self.manifest.carry_parser_out(sample[0])
+            self.nsamples += 1
+            n_carried += carried is not None
+            yield sample, carried
+        logging.info(f'{n_carried} samples carried over from the previous output, \
+{self.nsamples-n_carried} samples generated.')
+
+    def sample_files(self, sample_mapping):
+        # names of the appendix files referenced by the sample, in order
+        appendix = self.open_appendix()
+        files = []
+        for file in sample_mapping:
+            if file in appendix and file not in files:
+                files.append(file)
+        return files
+
+    def map_samples(self, method, samples):
+        '''
+        Call method on every sample and yield the results in the order of
+        samples, using a process pool if self.workers > 1.
+        '''
+        if self.workers > 1:
+            yield from self.map_parallel(method, samples)
+        elif method == 'run_sample':
+            # stage the appendix files of the next sample while the current
+            # one is processed
+            samples = iter(samples)
+            sample = next(samples, None)
+            while sample is not None:
+                upcoming = next(samples, None)
+                if upcoming is not None:
+                    self.stage_sample(upcoming)
+                yield self.profile_sample(method, sample)
+                sample = upcoming
+        else:
+            for sample in samples:
+                yield self.profile_sample(method, sample)
+
+    def profile_sample(self, method, sample_mapping):
+        # time the stages of the sample, and run it under cProfile if requested
+        with self.profile.sample(sample_mapping[0], self.cache_counters):
+            # the verification of the sample is not profiled
+            if self.cprofile_sample is not None and \
+                method != 'verify_sample' and \
+                str(sample_mapping[0]) == str(self.cprofile_sample):
+                profiler = cProfile.Profile()
+                result = profiler.runcall(getattr(self, method), sample_mapping)
+                path = f'{self.output_zip}.{sample_mapping[0]}.prof'
+                profiler.dump_stats(path)
+                logging.info(f'cProfile stats of {sample_mapping[0]} saved as \
+{path}.')
+                return result
+            return getattr(self, method)(sample_mapping)
+
+    def cache_counters(self):
+        appendix = getattr(self, 'appendix', None)
+        return {
+            'appendix_cache_hits': appendix.hits if appendix else 0,
+            'appendix_cache_misses': appendix.misses if appendix else 0,
+            'inp_cache_hits': self.inp_cache.hits,
+            'inp_cache_disk_hits': self.inp_cache.disk_hits,
+            'inp_cache_misses': self.inp_cache.misses,
+        }
+
+    def map_parallel(self, method, samples):
+        if self.worker_pool is not None:
+            yield from self.worker_pool.map(self, method, samples)
+            return
+        # spawn the workers, forking while the log listener thread is running
+        # could copy held locks into the children
+        mp_context = multiprocessing.get_context('spawn')
+        # worker processes send their log records back through a queue, the
+        # listener writes them with the handlers configured in this process
+        with mp_context.Manager() as manager:
+            log_queue = manager.Queue()
+            listener = logging.handlers.QueueListener(log_queue,
+                *logging.getLogger().handlers)
+            listener.start()
+            try:
+                with ProcessPoolExecutor(max_workers=self.workers,
+                    mp_context=mp_context, initializer=_init_worker,
+                    initargs=(self, log_queue)) as pool:
+                    # keep a bounded number of samples in flight and collect
+                    # the results in order, so the output is deterministic
+                    pending = deque()
+                    for sample in samples:
+                        pending.append((sample[0], pool.submit(
+                            _run_sample_worker, method, sample)))
+                        if len(pending) >= 4*self.workers:
+                            yield self.collect(*pending.popleft())
+                    while pending:
+                        yield self.collect(*pending.popleft())
+            finally:
+                listener.stop()
+
+    def collect(self, sample_id, future):
+        # workers send the timings of the sample along with the result
+        result, record = future.result()
+        self.profile.merge_sample(sample_id, record)
+        return result
+
+    def __getstate__(self):
+        # the mapping reader, the open input zip and the manifest are not
+        # needed by the workers, samples are sent one at a time. The compiled
+        # template is sent along if cheaper than compiling it again
+        state = self.__dict__.copy()
+        for attr in ('mapping', 'appendix', 'manifest', 'previous_output',
+            'io_pool', 'staged', 'templates', 'output', 'verify_index',
+            'worker_pool'):
+            state.pop(attr, None)
+        # the workers of a WorkerPool keep their compiled templates
+        if self.worker_pool is not None or not getattr(state.get('template'),
+            'send_to_workers', False):
+            state.pop('template', None)
+        return state
 
     def run_sample(self, sample_mapping):
         logging.info(f'Processing {sample_mapping[0]}.')
         # create a folder for each sample using sample id as the name
         # assume sample id is always the first item in sample_mapping
         sample_folder = os.path.join(self.tempdir,sample_mapping[0])
-        os.mkdir(sample_folder)
+        # copy and paste the appendix datafiles into the folder, unless
+        # already staged ahead of this sample
+        self.open_io_pool()
+        files, copies = self.staged.pop(sample_mapping[0], None) or \
+            self.stage_sample(sample_mapping, prefetch=False)
+        appendix = self.open_appendix()
+        with self.profile.stage('appendix_wait'):
+            wait(copies)
+        for file, copy in zip(files, copies):
+            # thread time, may exceed the wall time
+            nbytes = appendix.getinfo(file).file_size
+            extract_seconds, copy_seconds = copy.result()
+            self.profile.add('zip_extraction', extract_seconds, nbytes)
+            self.profile.add('appendix_copy', copy_seconds, nbytes)
         # keep track of the inp files
-        inps = []
-        # copy and paste the appendix datafiles into the folder
-        for file in sample_mapping:
-            if isinstance(file,str) and \
-            os.path.exists(os.path.join(self.extracted_datafiles_abspath,file)):
-                shutil.copy(os.path.join(self.extracted_datafiles_abspath,file),
-                    os.path.join(sample_folder,file))
-                if os.path.splitext(file)[1].lower() == '.inp':
-                    inps.append(os.path.join(sample_folder,file))
+        inps = [file for file in files
+            if os.path.splitext(file)[1].lower() == '.inp']
+        inp_paths = {file: os.path.join(sample_folder,file) for file in inps}
+        parser_out = self.parse_sample(sample_mapping[0], inps, inp_paths)
+        # fill the master template into the folder
+        self.update_template(sample_folder, self.master_template_name,
+            sample_mapping, parser_out)
+        # recorded in the manifest for the verification
+        return parser_out
+
+    def stage_sample(self, sample_mapping, prefetch=True):
+        '''
+        Create the sample folder and submit the copies of the appendix
+        datafiles of the sample to the I/O threads.
+
+        Output:
+        :return: names of the appendix files and the futures of their copies
+        :rtype: tuple(list, list)
+        '''
+        sample_folder = os.path.join(self.tempdir,sample_mapping[0])
+        os.mkdir(sample_folder)
+        appendix = self.open_appendix()
+        pool = self.open_io_pool()
+        files = self.sample_files(sample_mapping)
+        copies = [pool.submit(appendix.copy, file,
+            os.path.join(sample_folder,file)) for file in files]
+        if prefetch:
+            self.staged[sample_mapping[0]] = (files, copies)
+        return files, copies
+
+    def open_io_pool(self):
+        # every process has its own threads, created on first use
+        if getattr(self, 'io_pool', None) is None:
+            self.io_pool = ThreadPoolExecutor(max_workers=self.io_threads,
+                thread_name_prefix='appendix_io')
+            # sample id -> files and copies submitted ahead of the sample
+            self.staged = {}
+        return self.io_pool
+
+    def close_io_pool(self):
+        if getattr(self, 'io_pool', None) is not None:
+            self.io_pool.shutdown()
+            self.io_pool = None
+
+    def build_sample(self, sample_mapping):
+        '''
+        Streaming counterpart of run_sample, nothing is written to disk.
+
+        Output:
+        :return: sample id, names of the appendix members in the input zip
+            that belong to the sample, the filled master template and the
+            inp_parser output
+        :rtype: tuple(str, list, bytes, dict)
+        '''
+        logging.info(f'Processing {sample_mapping[0]}.')
+        # appendix members referenced by the sample
+        files = self.sample_files(sample_mapping)
+        inps = [file for file in files
+            if os.path.splitext(file)[1].lower() == '.inp']
+        parser_out = self.parse_sample(sample_mapping[0], inps)
+        # fill the master template in memory
+        buffer = io.BytesIO()
+        self.template.render(sample_mapping, parser_out, buffer, self.profile)
+        return sample_mapping[0], files, buffer.getvalue(), parser_out
+
+    def open_appendix(self):
+        # worker processes open their own index of the input zip, the cache
+        # size is shared among the processes
+        if getattr(self, 'appendix', None) is None:
+            if self.appendix_files is not None:
+                self.appendix = DirectoryAppendix(self.appendix_files)
+            else:
+                self.appendix = AppendixIndex(self.zipped_datafiles_abspath,
+                    cache_size=self.cache_size//self.workers,
+                    cache_root=getattr(self, 'cache_root', None))
+        return self.appendix
+
+    def close_appendix(self):
+        if getattr(self, 'appendix', None) is not None:
+            logging.info(f'Appendix cache: {self.appendix.hits} hits, \
+{self.appendix.misses} misses.')
+            self.appendix.close()
+            self.appendix = None
+
+    def parse_sample(self, sample_id, inps, inp_paths=None):
+        '''
+        Call inp_parser on the inp files of a sample if self.parse_inp. Several
+        inp files are parsed concurrently by the I/O threads and merged with
+        inp_parser.merge_outputs, the first file in the mapping wins.
+
+        Input:
+        :param inps: names of the inp files of the sample in the zipped
+            datafiles, in the order of the mapping
+        :type inps: list
+
+        :param inp_paths: inp file name -> path of a copy on disk, the inp
+            files are read from the zipped datafiles if not given
+        :type inp_paths: dict or NoneType
+        '''
         # init inp parser output dict
         parser_out = {}
-        if self.parse_inp:
-            # call parser if .inp file detected, assume only 1 inp file per sample
-            if len(inps) > 1:
-                print(f'Warning: more than 1 inp files detected for \
-{sample_mapping[0]}, only parsing {inps[0]}.')
-                logging.warning(f'More than 1 inp files detected for \
-{sample_mapping[0]}, only parsing {inps[0]}.')
-            if inps:
-                # skip *Equation and *Nset
-                parser = Parser(inps[0], skip={'*Equation','*Nset'})
+        if self.parse_inp and inps:
+            inp_paths = inp_paths or {}
+            if len(inps) == 1:
+                return self.parse_inp_file(inps[0], inp_paths.get(inps[0]))
+            from inp_parser.inp_parser import merge_outputs
+            pool = self.open_io_pool()
+            outputs = [pool.submit(self.parse_inp_file, inp, inp_paths.get(inp))
+                for inp in inps]
+            parser_out = merge_outputs([output.result() for output in outputs])
+            logging.info(f'{len(inps)} inp files merged for {sample_id}: \
+{", ".join(inps)}.')
+        return parser_out
+
+    def parse_inp_file(self, inp, path=None):
+        # skip *Equation and *Nset
+        skip = {'*Equation','*Nset'}
+        # identical inp files are only parsed once, the cache is keyed by the
+        # content of the file
+        appendix = self.open_appendix()
+        info = appendix.getinfo(inp)
+        digest = self.inp_cache.digest_fileobj(lambda: appendix.open(inp),
+            appendix.file_id(inp))
+        key = self.inp_cache.key(digest, skip)
+        parser_out = self.inp_cache.get(key)
+        if parser_out is None:
+            # only keep what goes into the template
+            from inp_parser.inp_parser import Parser
+            with self.profile.stage('inp_parse', info.file_size):
+                if path is not None:
+                    parser = Parser(path, skip=skip, stream=True, fast=True)
+                else:
+                    with io.TextIOWrapper(appendix.open(inp)) as f:
+                        parser = Parser(f, skip=skip, stream=True)
                 parser_out = parser.to_dict()
-        # copy and paste the master template into the folder
-        shutil.copy(self.master_template_abspath,
-            os.path.join(sample_folder,self.master_template_name))
-        # update the master template
-        self.update_template(sample_folder, self.master_template_name,
-            sample_mapping, parser_out)
+            self.inp_cache.put(key, parser_out)
+        return parser_out
 
-    ## Modify master template in place
+    ## Fill the compiled master template and save it into base_dir
     def update_template(self, base_dir, master_template, sample_mapping,
         parser_out):
         '''
         Input:
-        :param sample_mapping: a row in the mapping DataFrame
-        :type sample_mapping: pandas.Series
-        '''
-        wb = openpyxl.load_workbook(os.path.join(base_dir,master_template))
-        ignore_sheets = {'legend','4. Characterization Methods',
-            'Characterization Methods to Add','Dropdown menu choices'}
-        for sheet in wb:
-            # ignore irrelevant worksheets
-            if sheet.title in ignore_sheets:
-                continue
-            # since col 1 is always property names, we can skip it
-            for row in sheet.iter_rows(min_col=2):
-                for cell in row:
-                    if isinstance(cell.value,str) and cell.value.startswith('$'):
-                        cell.value = sample_mapping[cell.value]
-            # loop through the sheet again to update info parsed from inp files
-            for row in sheet.iter_rows():
-                if row[0].value in parser_out:
-                    row_header = row[0].value
-                    # example of parser_out[row_header]:
-                    # ['inserted by inp_parser', 'CPE4R']
-                    for i,v in enumerate(parser_out[row_header]):
-                        if v:
-                            if row[i+1].value is not None:
-                                print(f'Warning: {row[i+1]} with value {row[i+1].value} overwritten as {v}')
-                                logging.warning(f'{row[i+1]} with value {row[i+1].value} overwritten as {v}')
-                            row[i+1].value = v
-        wb.save(os.path.join(base_dir,master_template))
+        :param sample_mapping: a row of the mapping
+        :type sample_mapping: mapping_reader.MappingRow
+        '''
+        self.template.render(sample_mapping, parser_out,
+            os.path.join(base_dir,master_template), self.profile)
+
+
+## Imports deferred to keep the start of the command line fast
+def load_engines():
+    # openpyxl and numpy are imported with the templating engines
+    from template_engine import ENGINES
+    return ENGINES
+
+def progress(iterable, total=None):
+    from tqdm import tqdm
+    return tqdm(iterable, total=total)
+
+
+## Writer thread operations of the output zip files
+def write_members(zf, members, archive):
+    # copy a sample folder of a previous output zip
+    for info in members:
+        if info.is_dir():
+            archive.add_folder(info.filename)
+        else:
+            with zf.open(info) as src:
+                archive.add_fileobj(info.filename, src, info.date_time)
+
+def write_sample(appendix, sample_id, files, workbook_name, workbook, archive):
+    # appendix files from the input and the filled master template
+    archive.add_folder(sample_id)
+    for file in files:
+        with appendix.open(file) as src:
+            archive.add_fileobj(f'{sample_id}/{file}', src,
+                appendix.getinfo(file).date_time)
+    archive.add_bytes(workbook_name, workbook)
+
+def write_folder(root, sample_id, archive):
+    # a staged sample folder
+    for folder, dirs, files in os.walk(os.path.join(root, sample_id)):
+        archive.add_folder(os.path.relpath(folder, root).replace(os.sep, '/'))
+        for file in sorted(files):
+            path = os.path.join(folder, file)
+            archive.add_file(os.path.relpath(path, root).replace(os.sep, '/'),
+                path)
+
+def folder_size(folder):
+    return sum(os.path.getsize(os.path.join(root, file))
+        for root, dirs, files in os.walk(folder) for file in files)
+
+
+## Worker process helpers for batch_curation.map_parallel
+_worker_bc = None
+
+def _init_worker(bc, log_queue):
+    global _worker_bc
+    _route_worker_logging(log_queue)
+    if getattr(bc, 'template', None) is None:
+        bc.template = load_engines()[bc.engine](bc.master_template_abspath)
+    _worker_bc = _prepare_worker(bc)
+
+def _route_worker_logging(log_queue):
+    # route logging of this worker into the log file of the main process
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.setFormatter(logging.Formatter('%(processName)s - %(message)s'))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(logging.INFO)
+
+def _prepare_worker(bc):
+    # timings of this worker are sent back per sample
+    bc.profile = RunProfile(enabled=bc.profile.enabled)
+    # never share the file handle of the input zip with the main process
+    bc.appendix = None
+    return bc
+
+def _run_sample_worker(method, sample_mapping):
+    result = _worker_bc.profile_sample(method, sample_mapping)
+    return result, _worker_bc.profile.pop_sample(sample_mapping[0])
+
+
+## Worker processes kept between runs, see curation_service.CurationEngine
+class WorkerPool():
+    def __init__(self, workers, master_template, engine='openpyxl'):
+        '''
+        Process pool shared by the runs of a long-lived process. The workers
+        import the templating engine and compile the master template once,
+        and keep their inp_parser cache between runs. The state of a run is
+        fetched by every worker on its first sample of the run.
+
+        Input:
+        :param workers: number of worker processes
+        :type workers: int
+
+        :param master_template: path of the master template compiled by every
+            worker at start, other templates are compiled when first used
+        :type master_template: str
+
+        :param engine: templating engine of master_template
+        :type engine: str
+        '''
+        self.workers = max(1, workers)
+        # spawn the workers, forking while the log listener thread is running
+        # could copy held locks into the children
+        mp_context = multiprocessing.get_context('spawn')
+        self.manager = mp_context.Manager()
+        self.log_queue = self.manager.Queue()
+        # run token -> pickled batch_curation of the run
+        self.states = self.manager.dict()
+        self.tokens = count()
+        self.executor = ProcessPoolExecutor(max_workers=self.workers,
+            mp_context=mp_context, initializer=_init_pool_worker,
+            initargs=(self.log_queue, self.states, engine,
+            os.path.abspath(master_template)))
+
+    def map(self, bc, method, samples):
+        '''
+        Call method of bc on every sample in the workers and yield the results
+        in the order of samples, see batch_curation.map_parallel.
+        '''
+        token = next(self.tokens)
+        self.states[token] = pickle.dumps(bc)
+        # log records of the workers go to the handlers of the current run
+        listener = logging.handlers.QueueListener(self.log_queue,
+            *logging.getLogger().handlers)
+        listener.start()
+        try:
+            pending = deque()
+            for sample in samples:
+                pending.append((sample[0], self.executor.submit(
+                    _run_pool_sample, token, method, sample)))
+                if len(pending) >= 4*self.workers:
+                    yield bc.collect(*pending.popleft())
+            while pending:
+                yield bc.collect(*pending.popleft())
+        finally:
+            # samples left when the caller stops early must not run against
+            # the state of the next run
+            for sample_id, future in pending:
+                future.cancel()
+            wait([future for sample_id, future in pending])
+            listener.stop()
+            del self.states[token]
+
+    def shutdown(self):
+        self.executor.shutdown()
+        self.manager.shutdown()
+
+# token of the run held by _worker_bc, manager dict of the run states and
+# (engine, path) -> (digest, compiled template) of a WorkerPool worker
+_worker_token = None
+_worker_states = None
+_worker_templates = {}
+
+def _init_pool_worker(log_queue, states, engine, master_template):
+    global _worker_states
+    _route_worker_logging(log_queue)
+    _worker_states = states
+    _worker_templates[(engine, master_template)] = (
+        file_digest(master_template), load_engines()[engine](master_template))
+
+def _run_pool_sample(token, method, sample_mapping):
+    global _worker_bc, _worker_token
+    if token != _worker_token:
+        bc = pickle.loads(_worker_states[token])
+        previous = _worker_bc
+        if previous is not None:
+            # release the input zip and threads of the previous run, keep
+            # its inp_parser cache
+            if getattr(previous, 'appendix', None) is not None:
+                try:
+                    previous.appendix.close()
+                except OSError:
+                    # the extracted files were removed with the folders of
+                    # the previous run
+                    pass
+            previous.close_io_pool()
+            if getattr(previous, 'verify_index', None) is not None:
+                previous.verify_index.close()
+            if previous.inp_cache.cache_dir == bc.inp_cache.cache_dir:
+                bc.inp_cache = previous.inp_cache
+        bc.templates = _worker_templates
+        bc.template = bc.load_template(bc.template_digest)
+        _worker_bc = _prepare_worker(bc)
+        _worker_token = token
+    return _run_sample_worker(method, sample_mapping)
 
 
 def readOptions(args=sys.argv[1:]):
@@ -187,6 +931,22 @@ def readOptions(args=sys.argv[1:]):
     parser.add_argument("-z", "--zipped_datafiles", required=True, help="Type the file name of the zip file that contains appendix data files.")
     parser.add_argument("-o", "--output_zip", help="[Optional] Type the file name for the output zip file. Default to be 'batch_template_output.zip'")
     parser.add_argument("-p", "--parse_inp", dest='parse_inp', default=False, action='store_true', help="Use this argument to enable inp parsing during batch curation. The corresponding cells in the template will be overwritten.")
+    parser.add_argument("-w", "--workers", default=1, type=int, help="[Optional] Type the number of worker processes used to generate the samples. Default to 1.")
+    parser.add_argument("-s", "--stream_output", dest='stream_output', default=False, action='store_true', help="Use this argument to stream the samples straight into the output zip file without staging folders on disk.")
+    parser.add_argument("-c", "--cache_size_mb", default=1024, type=float, help="[Optional] Type the size cap in MB of the appendix data files extracted on disk. Default to 1024.")
+    parser.add_argument("--inp_cache_dir", help="[Optional] Type the directory of the on-disk cache of inp parser outputs, reused across runs.")
+    parser.add_argument("--inp_cache_size_mb", default=512, type=float, help="[Optional] Type the size cap in MB of the on-disk inp parser cache. Default to 512.")
+    parser.add_argument("-i", "--incremental", dest='incremental', default=False, action='store_true', help="Use this argument to only regenerate the samples whose inputs changed since the previous run, unchanged samples are copied from the previous output zip file.")
+    parser.add_argument("--profile", dest='profile', default=False, action='store_true', help="Use this argument to save the time, bytes moved and cache hits of every stage per sample and for the whole run as {output_zip}.profile.json.")
+    parser.add_argument("--cprofile_sample", help="[Optional] Type the id of a sample to run under cProfile, the stats are saved as {output_zip}.{sample id}.prof.")
+    parser.add_argument("-e", "--engine", default='openpyxl', choices=['openpyxl', 'xml'], help="[Optional] Type the templating engine. 'xml' rewrites only the changed cells in the sheet XML of the master template instead of loading and saving the workbook with openpyxl for every sample. Default to openpyxl.")
+    parser.add_argument("--shards", default=1, type=int, help="[Optional] Type the number of output zip files written concurrently, samples are distributed round robin. Default to 1.")
+    parser.add_argument("--shard_samples", type=int, help="[Optional] Type the maximum number of samples per output zip file.")
+    parser.add_argument("--shard_size_mb", type=float, help="[Optional] Type the maximum uncompressed size in MB per output zip file.")
+    parser.add_argument("--compresslevel", type=int, choices=range(10), help="[Optional] Type the deflate level 0-9 of the output zip files. Default to the zlib default.")
+    parser.add_argument("--verify", dest='verify', default=False, action='store_true', help="Use this argument to check every sample of the output zip file after the run: appendix files present, mapping and inp parser values in the master template and no placeholder left. The result of every sample is saved as {output_zip}.verify.csv.")
+    parser.add_argument("--io_threads", default=4, type=int, help="[Optional] Type the number of threads per process extracting and copying the appendix data files, the files of the next sample are staged while the current sample is processed. Default to 4.")
+    parser.add_argument("--store_ext", nargs='*', default=sorted(STORE_EXTENSIONS), help="[Optional] Type the extensions of the files stored without compression in the output zip files. Default to already compressed formats, e.g. .mat .png .xlsx.")
     opts = parser.parse_args(args)
     return opts
 
@@ -194,6 +954,8 @@ def readOptions(args=sys.argv[1:]):
 if __name__ == '__main__':
     options = readOptions(sys.argv[1:])
     bc = batch_curation(**vars(options))
+    if bc.verify_failures:
+        sys.exit(1)
 # Example
 # base_dir = './example'
 # mapping = 'example_mapping.xlsx'
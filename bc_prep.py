@@ -3,13 +3,16 @@
 
 import json
 from glob import glob
-import pandas as pd
-import numpy as np
+# numpy and pandas are imported by the functions using them, the master
+# curve workers and --help do not load pandas
 import os
-import tempfile
+import sys
 import shutil
-import re
+import zipfile
+import tempfile
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 # configure logging
 logging.basicConfig(
@@ -21,98 +24,307 @@ logging.basicConfig(
 
 def mc_2_ep_epp(mc_file):
     # assumption: master curve are saved by default numpy.savetxt with MPa as modulus unit
-    mc = np.loadtxt(mc_file)
     # get name for ep and epp
     ep_file = os.path.splitext(mc_file)[0] + '_ep.csv'
     epp_file = os.path.splitext(mc_file)[0] + '_epp.csv'
-    # save ep
-    np.savetxt(ep_file, mc[:,:2], header="""Frequency (Hz),E' (MPa)""",delimiter=',',comments='')
-    np.savetxt(epp_file, mc[:,[0,2]], header="""Frequency (Hz),E" (MPa)""",delimiter=',',comments='')
+    # skip if both files are newer than the master curve
+    if is_up_to_date(mc_file, [ep_file, epp_file]):
+        return {'ep':ep_file, 'epp':epp_file}
+    import numpy as np
+    # np.loadtxt is C based since numpy 1.23
+    mc = np.loadtxt(mc_file)
+    # save ep and epp, same format as np.savetxt
+    save_csv(ep_file, mc[:,:2], """Frequency (Hz),E' (MPa)""")
+    save_csv(epp_file, mc[:,[0,2]], """Frequency (Hz),E" (MPa)""")
     return {'ep':ep_file, 'epp':epp_file}
 
-# move and rename files
-def mv_rename_file(filename, dest_folder):
-    original_name = filename # save original name
-    # figure out the new filename
-    # remove leading './' if present
-    if filename.startswith('./'):
-        filename = filename[2:]
-    # replace '/' and '\\' with '_'
-    filename = re.sub(r'[\\/]+','_',filename)
-    # copy the original file into the new folder with new name
-    shutil.copy(original_name, os.path.join(dest_folder, filename))
-    # rename by returning the new name, use this function with Series.apply()
-    return filename
-
-def update_df_filename(df,dest_folder):
+def save_csv(filename, array, header, rows=100000):
+    # format many rows with one % operation instead of one per row as in
+    # np.savetxt, output is identical
+    row_fmt = ','.join(['%.18e']*array.shape[1]) + '\n'
+    # written next to filename and moved into place once complete, an
+    # interrupted run never leaves a truncated file newer than its source
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+        suffix='.part')
+    try:
+        with os.fdopen(fd, 'w', newline='') as f:
+            f.write(header + '\n')
+            for start in range(0, len(array), rows):
+                block = array[start:start+rows]
+                f.write(row_fmt*len(block) % tuple(block.ravel().tolist()))
+        # mkstemp creates the file readable by the owner only
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, filename)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def is_up_to_date(source, outputs):
+    try:
+        mtime = os.path.getmtime(source)
+        return all(os.path.getmtime(out) >= mtime for out in outputs)
+    except OSError:
+        return False
+
+def convert_master_curves(mcs, workers=1):
+    '''
+    Call mc_2_ep_epp on every master curve, using a process pool if
+    workers > 1.
+
+    Input:
+    :param mcs: file names of the master curves
+    :type mcs: list
+
+    :param workers: number of worker processes
+    :type workers: int
+
+    Output:
+    :return: master curve -> {'ep': ep file, 'epp': epp file}
+    :rtype: dict
+    '''
+    if workers > 1 and len(mcs) > 1:
+        with ProcessPoolExecutor(max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn')) as pool:
+            files = list(pool.map(mc_2_ep_epp, mcs,
+                chunksize=max(1, len(mcs)//(4*workers))))
+    else:
+        files = [mc_2_ep_epp(mc) for mc in mcs]
+    logging.info(f'{len(mcs)} master curves converted to ep and epp.')
+    return dict(zip(mcs, files))
+
+# flattened names of files in the zip
+def flatten_filenames(filenames):
+    # remove leading './' if present, replace '/' and '\\' with '_'
+    return filenames.str.replace(r'^\./', '', regex=True).str.replace(
+        r'[\\/]+', '_', regex=True)
+
+def update_df_filename(df):
+    '''
+    Replace the file names in the columns holding files with their flattened
+    names in the zip.
+
+    Output:
+    :return: updated df, and flattened name -> original file name of every
+        unique file
+    :rtype: tuple(pandas.DataFrame, dict)
+    '''
+    import pandas as pd
     outdf = df.copy()
-    for col,b in df.iloc[0].apply(os.path.exists).items():
+    files = {}
+    for col,b in df.iloc[0].apply(lambda x: isinstance(x,str) and
+        os.path.exists(x)).items():
         if b:
-            outdf[col] = outdf[col].apply(lambda x: mv_rename_file(x,dest_folder))
+            outdf[col] = flatten_filenames(df[col])
+            # every file once, no matter how many samples share it
+            pairs = pd.DataFrame({'name': outdf[col], 'src': df[col]}
+                ).drop_duplicates()
+            for name, src in zip(pairs['name'], pairs['src']):
+                if files.get(name, src) != src:
+                    print(f"Warning: {src} and {files[name]} are both named {name} in the zip, keeping {src}.")
+                    logging.warning(f"{src} and {files[name]} are both named {name} in the zip, keeping {src}.")
+                files[name] = src
             print(f"{col} column updated.")
             logging.info(f"{col} column updated.")
     logging.info('update_df_filename() successful.')
-    return outdf
+    return outdf, files
+
+def zip_files(files, zip_to):
+    # write the files straight from their original location
+    with zipfile.ZipFile(zip_to, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, src in files.items():
+            zf.write(src, name)
+
+
+# characters that may follow a complete json value
+JSON_DELIMITERS = ' \t\r\n,:]}'
 
+def iter_json_items(json_dir, chunk_size=1024*1024):
+    '''
+    Yield the (key, value) pairs of the top-level object of a json file one
+    at a time, only the current value is held in memory.
+    '''
+    decoder = json.JSONDecoder()
+    with open(json_dir, 'r') as f:
+        buffer = ''
+        pos = 0
+        eof = False
+
+        def read(size):
+            # drop the parsed text and read at least size more characters
+            nonlocal buffer, pos, eof
+            buffer = buffer[pos:]
+            pos = 0
+            chunk = f.read(max(size, chunk_size))
+            eof = not chunk
+            buffer += chunk
+
+        def next_char():
+            # skip whitespace, '' at the end of the file
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    return buffer[pos:pos+1]
+                read(chunk_size)
+
+        def expect(chars):
+            nonlocal pos
+            char = next_char()
+            if not char or char not in chars:
+                raise ValueError(f'Expecting one of {chars!r} in {json_dir}, \
+found {char!r}.')
+            pos += 1
+            return char
+
+        def decode():
+            # decode the next value, reading more until it is complete
+            nonlocal pos
+            next_char()
+            size = chunk_size
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                else:
+                    # a number at the end of the buffer may be cut, e.g. 1e5
+                    # read as 1, it is complete once a delimiter follows
+                    if eof or (end < len(buffer) and
+                        buffer[end] in JSON_DELIMITERS):
+                        pos = end
+                        return value
+                read(size)
+                size *= 2
+
+        expect('{')
+        if next_char() == '}':
+            return
+        while True:
+            key = decode()
+            expect(':')
+            yield key, decode()
+            if expect(',}') == '}':
+                return
+
+def read_json_columns(json_dir, fields):
+    '''
+    Build the columns of the sample mapping from the json file, one sample at
+    a time. Only the requested fields of every sample are kept.
+
+    Input:
+    :param json_dir: json file, sample name -> simulation parameters
+    :type json_dir: str
+
+    :param fields: names of the columns, derived columns pnc_mc, SID,
+        n_layers, layer, mtx_ep and mtx_epp are computed, master_curve is
+        always read
+    :type fields: list
+
+    Output:
+    :return: field -> list of values in the order of the samples
+    :rtype: dict
+    '''
+    import numpy as np
+    derived = {'pnc_mc', 'SID', 'n_layers', 'layer', 'mtx_ep', 'mtx_epp'}
+    raw = [field for field in dict.fromkeys(fields + ['master_curve'])
+        if field not in derived]
+    columns = {field: [] for field in raw + ['pnc_mc', 'SID', 'n_layers',
+        'layer']}
+    # fields seen in at least one sample
+    seen = set()
+    for i, (pnc_mc, sample) in enumerate(iter_json_items(json_dir)):
+        for field in raw:
+            columns[field].append(sample.get(field, np.nan))
+        seen.update(field for field in raw if field in sample)
+        # pnc_mc is the key of the sample
+        columns['pnc_mc'].append(pnc_mc)
+        # SID, temporary, maybe sort the df first
+        columns['SID'].append(f"S{i+1}")
+        # n_layers and layer, assume 1 layer
+        layers = sample.get('layers')
+        columns['n_layers'].append(len(layers) if layers is not None else np.nan)
+        columns['layer'].append(layers[0] if layers else np.nan)
+    missing = [field for field in raw if field not in seen]
+    if missing:
+        logging.error(f'{missing} not found in {json_dir}.')
+        raise KeyError(f'{missing} not found in {json_dir}.')
+    logging.info(f'{len(columns["SID"])} samples read from {json_dir}.')
+    return columns
 
 def prepare_batch_curation(json_dir, base_dir='./', zip_to='./datafiles.zip', columns_out=None,
-                          mapping_to='./sample_mapping.csv'):
-    '''base_dir is currently unused.'''
+                          mapping_to='./sample_mapping.csv', workers=1):
+    '''base_dir is currently unused. workers is the number of processes
+    converting the master curves. The zip or the mapping is not written if
+    zip_to or mapping_to is None.
+
+    Output:
+    :return: sample mapping, and file name in the zip -> path of every
+        datafile, the inputs of batch_curation
+    :rtype: tuple(pandas.DataFrame, dict)
+    '''
+    import pandas as pd
     # default columns_out
     if not columns_out:
         columns_out = ['$SID', '$mtx_ep', '$mtx_epp', '$ParRu', '$ParRv', '$VfFree', '$fil_youngs',
                '$fil_poisson', '$n_layers', '$layer', '$intph_shift', '$intph_l_brd', '$intph_r_brd',
                '$fmin', '$fmax', '$num_freq', '$displacement', '$intph_img', '$pix', '$pnc_mc']
-    # read and preprocess df from json
-    with open(json_dir,'r') as f:
-        full_data = json.load(f)
-    # build df
-    df = pd.DataFrame.from_dict(full_data,orient='index')
+    # read the json one sample at a time into the columns of df
+    columns = read_json_columns(json_dir, [col[1:] for col in columns_out])
     # collect all master curve
-    mcs = df['master_curve'].unique()
+    mcs = pd.unique(pd.Series(columns['master_curve'], dtype=object))
     # convert to ep.csv and epp.csv
-    mc_map = {mc:mc_2_ep_epp(mc) for mc in mcs}
+    mc_map = convert_master_curves(list(mcs), workers)
     # update df with mc_map
     # mtx_ep and mtx_epp
-    df['mtx_ep'] = df['master_curve'].apply(lambda x:mc_map[x]['ep'])
-    df['mtx_epp'] = df['master_curve'].apply(lambda x:mc_map[x]['epp'])
-    # pnc_mc pandas < 1.5.0
-    # df['pnc_mc'] = df.index
-    # df = df.reset_index(drop=True)
-    # pnc_mc pandas >= 1.5.0
-    df = df.reset_index(names=['pnc_mc'])
-    # n_layers and layer
-    df['n_layers'] = df.layers.apply(len)
-    df['layer'] = df.layers.apply(lambda x:x[0]) # assume 1 layer
-    # SID, temporary, maybe sort the df first
-    df['SID'] = df.index
-    df['SID'] = df['SID'].apply(lambda x:f"S{x+1}")
+    columns['mtx_ep'] = [mc_map[x]['ep'] for x in columns['master_curve']]
+    columns['mtx_epp'] = [mc_map[x]['epp'] for x in columns['master_curve']]
+    # select and order by columns_out
+    df = pd.DataFrame({col:columns[col[1:]] for col in columns_out})
     # ParRu and ParRv are radius, in the template, we need diameter
     # double both values
-    df['ParRu'] = 2*df['ParRu']
-    df['ParRv'] = 2*df['ParRv']
-    # batch rename columns
-    df = df.rename(columns={col[1:]:col for col in columns_out}, errors="raise")
-    # select and order by columns_out
-    df = df[columns_out]
-    # create temporary directory
-    td = tempfile.TemporaryDirectory()
-    logging.info('Temporary directory created.')
-    # update filenames and copy/paste datafiles to td
-    df = update_df_filename(df,td.name)
-    # trim .zip from zip_to if present
-    if '.zip' in zip_to and zip_to[-4:] == '.zip':
-       zip_to = zip_to[:-4]
-    # zip everything in temporary directory to zip_to
-    shutil.make_archive(zip_to, 'zip', td.name)
-    logging.info(f'Files in the temporary directory are archived to {zip_to}.')
-    # dump sample mapping table
-    df.to_csv(mapping_to,index=False)
-    logging.info(f'Sample mapping saved as {mapping_to}.')
-    # clean up td
-    td.cleanup()
-    logging.info('Finished cleaning up the temporary directory.')
-    return
+    for col in ('$ParRu', '$ParRv'):
+        if col in df:
+            df[col] = 2*df[col]
+    # update filenames
+    df, files = update_df_filename(df)
+    if zip_to is not None:
+        # add .zip to zip_to if missing
+        if zip_to[-4:] != '.zip':
+           zip_to = zip_to + '.zip'
+        # zip the unique datafiles to zip_to
+        zip_files(files, zip_to)
+        logging.info(f'{len(files)} files are archived to {zip_to}.')
+    if mapping_to is not None:
+        # dump sample mapping table
+        df.to_csv(mapping_to,index=False)
+        logging.info(f'Sample mapping saved as {mapping_to}.')
+    return df, files
+
+def prepare_and_curate(json_dir, master_template, export_dir='./bc_prep_export',
+                       columns_out=None, workers=1, zip_to=None, mapping_to=None,
+                       **curation_options):
+    '''
+    Prepare the samples and generate the batch curation output in one go. The
+    mapping and the datafiles are handed to batch_curation in memory, the
+    zip and the mapping are only written if zip_to or mapping_to is given.
+    curation_options are passed to batch_curation, e.g. parse_inp,
+    output_zip, stream_output. The output zip is created in export_dir.
+    '''
+    # batch_curation pulls in openpyxl and the inp parser
+    from batch_curation import batch_curation
+    df, files = prepare_batch_curation(json_dir=json_dir,
+        zip_to=zip_to and os.path.join(export_dir, zip_to),
+        columns_out=columns_out,
+        mapping_to=mapping_to and os.path.join(export_dir, mapping_to),
+        workers=workers)
+    curation_options.setdefault('parse_inp', False)
+    return batch_curation(base_dir=export_dir,
+        master_template=os.path.abspath(master_template), mapping_tabular=df,
+        zipped_datafiles=files, workers=workers, **curation_options)
 
 if __name__ == '__main__':
     import argparse
@@ -135,6 +347,16 @@ if __name__ == '__main__':
         type=str, help="The file name to dump sample mapping table.")
     parser.add_argument("-t", "--master_template", required=True,
         help="Type the file name of your filled master template.")
+    parser.add_argument("-w", "--workers", default=1, type=int,
+        help="Number of worker processes converting the master curves, and generating the samples with --curate.")
+    parser.add_argument("--curate", default=False, action='store_true',
+        help="Run batch curation on the prepared samples in memory, the zip and the mapping are only written with --write_intermediate.")
+    parser.add_argument("--write_intermediate", default=False, action='store_true',
+        help="Also write the zip and the mapping with --curate.")
+    parser.add_argument("-p", "--parse_inp", default=False, action='store_true',
+        help="Enable inp parsing in batch curation with --curate.")
+    parser.add_argument("-o", "--output_zip",
+        help="File name of the batch curation output zip with --curate.")
     args = parser.parse_args()
 
     # make the folder for export if not exist
@@ -146,10 +368,25 @@ if __name__ == '__main__':
         os.path.join(args.export_dir,args.master_template))
     logging.info(f'Master template {args.master_template} copied to the export dir.')
 
+    if args.curate:
+        prepare_and_curate(
+            json_dir=args.json_dir,
+            master_template=args.master_template,
+            export_dir=args.export_dir,
+            columns_out=args.columns_out,
+            workers=args.workers,
+            zip_to=args.zip_to if args.write_intermediate else None,
+            mapping_to=args.mapping_to if args.write_intermediate else None,
+            parse_inp=args.parse_inp,
+            output_zip=args.output_zip,
+        )
+        sys.exit()
+
     prepare_batch_curation(
         json_dir=args.json_dir,
         base_dir=args.base_dir,
         zip_to=os.path.join(args.export_dir,args.zip_to),
         columns_out=args.columns_out,
         mapping_to=os.path.join(args.export_dir,args.mapping_to),
+        workers=args.workers,
     )
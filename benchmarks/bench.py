@@ -0,0 +1,377 @@
+## Synthetic-scale benchmarks of the batch curation pipeline
+## Run from the repo root, e.g.
+##   python benchmarks/bench.py --preset medium --json_out bench_medium.json
+##   python benchmarks/bench.py --preset medium --compare bench_medium.json
+
+# -------------------------------------------- file os and other general lib
+import os
+import sys
+import json
+import time
+import random
+import platform
+import tempfile
+import subprocess
+import zipfile
+# -------------------------------------------- for measurements
+import queue
+import resource
+import multiprocessing
+# -------------------------------------------- for command line arguments
+import argparse
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+PRESETS = {
+    'small': dict(samples=10, sheets=3, rows=100, placeholders=5, members=10,
+        member_kb=16, inps=2, nodes=10000, elements=10000, json_samples=10),
+    'medium': dict(samples=1000, sheets=5, rows=300, placeholders=10,
+        members=1000, member_kb=64, inps=10, nodes=1000000, elements=1000000,
+        json_samples=1000),
+    'large': dict(samples=100000, sheets=10, rows=300, placeholders=20,
+        members=100000, member_kb=256, inps=100, nodes=5000000,
+        elements=5000000, json_samples=20000),
+}
+
+# rows of the template that are overwritten with inp_parser outputs
+PARSER_ROWS = ['Software Used', 'Number of Elements', 'Element Type - Abaqus',
+    'Loading Type', 'Min frequency', 'Max frequency',
+    'Number of Frequency Intervals', 'Boundary Condition Type']
+
+## Synthetic inputs
+def make_inp(path, nodes, elements):
+    rng = random.Random(nodes)
+    with open(path, 'w') as f:
+        f.write('*Heading\n** synthetic model\n*Node\n')
+        for i in range(1, nodes+1):
+            f.write(f'{i}, {rng.random():.6f}, {rng.random():.6f}\n')
+        f.write('*Element, type=CPE4R\n')
+        for i in range(1, elements+1):
+            f.write(f'{i}, {i}, {i%nodes+1}, {(i+1)%nodes+1}, {(i+2)%nodes+1}\n')
+        f.write('*Nset, nset=all, generate\n1, %d, 1\n' % nodes)
+        f.write('*Material, name=matrix\n*Density\n1.2\n*Elastic\n3000., 0.35\n')
+        f.write('*Viscoelastic, frequency=TABULAR\n')
+        for i in range(30):
+            f.write(f'0.1, 0.2, 0.0, 0.0, {10**(i/10):.4f}\n')
+        f.write('*Boundary\nall, 1, 1, 0.01\n*Step\n')
+        f.write('*Steady State Dynamics, direct\n0.1, 100., 30\n*End Step\n')
+
+def make_template(path, sheets, rows, placeholders):
+    import openpyxl
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    names = []
+    for i in range(sheets):
+        ws = wb.create_sheet(f'{i+1}. Sheet')
+        for r in range(1, rows+1):
+            header = PARSER_ROWS[r-1] if i == 0 and r <= len(PARSER_ROWS) \
+                else f'Property {r}'
+            ws.cell(row=r, column=1, value=header)
+            ws.cell(row=r, column=4, value=f'unit {r}')
+        # spread the placeholders over the sheet
+        for j in range(placeholders):
+            name = f'$s{i}p{j}'
+            ws.cell(row=len(PARSER_ROWS) + 1 + j*(rows-len(PARSER_ROWS)-1)//placeholders,
+                column=2, value=name)
+            names.append(name)
+    # large sheet ignored by batch_curation
+    ws = wb.create_sheet('Dropdown menu choices')
+    for r in range(1, 20*rows+1):
+        for c in range(1, 6):
+            ws.cell(row=r, column=c, value=f'choice {r}-{c}')
+    wb.save(path)
+    return names
+
+def make_appendix(path, members, member_kb, inp_files):
+    rng = random.Random(members)
+    names = []
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for i in range(members):
+            name = f'data_{i}.mat'
+            zf.writestr(name, rng.randbytes(member_kb*1024))
+            names.append(name)
+        for inp in inp_files:
+            zf.write(inp, os.path.basename(inp))
+    return names
+
+def make_mapping(path, samples, placeholders, members, inps):
+    import csv
+    rng = random.Random(samples)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['$sid'] + placeholders + ['$data', '$inp'])
+        for i in range(samples):
+            writer.writerow([f'S{i+1}'] + [round(rng.random(), 6)
+                for _ in placeholders] + [members[i % len(members)],
+                os.path.basename(inps[i % len(inps)])])
+
+def make_prep_json(path, work_dir, json_samples):
+    import numpy as np
+    rng = random.Random(json_samples)
+    data = {}
+    # a few master curves shared by the samples
+    n_mc = max(1, json_samples//10)
+    for i in range(n_mc):
+        freq = np.logspace(-2, 6, 200)
+        np.savetxt(os.path.join(work_dir, 'mc', f'mc_{i}.txt'),
+            np.column_stack([freq, 1000+freq/1e3, 10+freq/1e4]))
+    for i in range(json_samples):
+        img = os.path.join('img', f'img_{i%n_mc}.mat')
+        data[f'run_{i}'] = {
+            'master_curve': os.path.join('mc', f'mc_{i%n_mc}.txt'),
+            'layers': [round(rng.random(), 3)],
+            'ParRu': rng.random(), 'ParRv': rng.random(),
+            'VfFree': rng.random(), 'fil_youngs': 70000, 'fil_poisson': 0.3,
+            'intph_shift': rng.random(), 'intph_l_brd': rng.random(),
+            'intph_r_brd': rng.random(), 'fmin': 0.01, 'fmax': 1e6,
+            'num_freq': 30, 'displacement': 0.01, 'intph_img': img, 'pix': 200,
+        }
+    for i in range(n_mc):
+        with open(os.path.join(work_dir, 'img', f'img_{i}.mat'), 'wb') as f:
+            f.write(rng.randbytes(16*1024))
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+def generate(work_dir, params):
+    '''
+    Generate all synthetic inputs in work_dir and return their paths.
+    '''
+    for folder in ('inp', 'mc', 'img'):
+        os.makedirs(os.path.join(work_dir, folder), exist_ok=True)
+    inps = [os.path.join(work_dir, 'inp', f'model_{i}.inp')
+        for i in range(params['inps'])]
+    # only the first model is full scale, the others are small copies
+    make_inp(inps[0], params['nodes'], params['elements'])
+    for inp in inps[1:]:
+        make_inp(inp, 1000, 1000)
+    placeholders = make_template(os.path.join(work_dir, 'template.xlsx'),
+        params['sheets'], params['rows'], params['placeholders'])
+    members = make_appendix(os.path.join(work_dir, 'datafiles.zip'),
+        params['members'], params['member_kb'], inps)
+    make_mapping(os.path.join(work_dir, 'mapping.csv'), params['samples'],
+        placeholders, members, inps)
+    make_prep_json(os.path.join(work_dir, 'params.json'), work_dir,
+        params['json_samples'])
+    return {'inp': inps[0], 'template': 'template.xlsx',
+        'mapping': 'mapping.csv', 'zip': 'datafiles.zip',
+        'json': 'params.json'}
+
+## Stages, each one runs in its own process to measure its peak RSS
+def stage_parse(work_dir, inputs, params):
+    from inp_parser.inp_parser import Parser
+    results = {}
+    for mode, kwargs in [('rows', {}), ('stream', dict(stream=True)),
+        ('fast', dict(stream=True, fast=True)),
+        ('arrays', dict(fast=True, arrays=True))]:
+        start = time.perf_counter()
+        Parser(inputs['inp'], skip={'*Equation','*Nset'}, **kwargs)
+        results[mode] = time.perf_counter() - start
+    return results, os.path.getsize(inputs['inp']), \
+        params['nodes'] + params['elements']
+
+def stage_update_template(work_dir, inputs, params):
+    import io
+    import pandas as pd
+    from template_engine import CompiledTemplate
+    from inp_parser.inp_parser import Parser
+    df = pd.read_csv(os.path.join(work_dir, inputs['mapping']))
+    parser_out = Parser(inputs['inp'], skip={'*Equation','*Nset'},
+        stream=True, fast=True).to_dict()
+    n = min(len(df), params.get('template_samples', 50))
+    start = time.perf_counter()
+    template = CompiledTemplate(os.path.join(work_dir, inputs['template']))
+    compile_time = time.perf_counter() - start
+    nbytes = 0
+    start = time.perf_counter()
+    for idx,sample in df.head(n).iterrows():
+        buffer = io.BytesIO()
+        template.render(sample, parser_out, buffer)
+        nbytes += buffer.tell()
+    return {'compile': compile_time, 'render': time.perf_counter() - start}, \
+        nbytes, n
+
+def stage_prepare(work_dir, inputs, params):
+    import bc_prep
+    start = time.perf_counter()
+    bc_prep.prepare_batch_curation(json_dir=inputs['json'],
+        zip_to=os.path.join(work_dir, 'prep_datafiles.zip'),
+        mapping_to=os.path.join(work_dir, 'prep_mapping.csv'))
+    return {'total': time.perf_counter() - start}, \
+        os.path.getsize(os.path.join(work_dir, 'prep_datafiles.zip')), \
+        params['json_samples']
+
+def stage_run(work_dir, inputs, params):
+    from batch_curation import batch_curation
+    start = time.perf_counter()
+    batch_curation(base_dir=work_dir, master_template=inputs['template'],
+        mapping_tabular=inputs['mapping'], zipped_datafiles=inputs['zip'],
+        parse_inp=True, output_zip='bench_output.zip',
+        workers=params['workers'], stream_output=params['stream'])
+    return {'total': time.perf_counter() - start}, \
+        os.path.getsize(os.path.join(work_dir, 'bench_output.zip')), \
+        params['samples']
+
+def stage_cold_start(work_dir, inputs, params):
+    # fresh interpreters, as when scripting many small invocations, best of
+    # a few runs
+    with open(os.path.join(work_dir, inputs['mapping'])) as f:
+        lines = f.readlines()[:3]
+    with open(os.path.join(work_dir, 'cold_mapping.csv'), 'w') as f:
+        f.writelines(lines)
+    # run from the work directory, the scripts write their log files into
+    # the current directory
+    batch_curation = os.path.join(REPO_DIR, 'batch_curation.py')
+    bc_prep = os.path.join(REPO_DIR, 'bc_prep.py')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None,
+        [REPO_DIR, os.environ.get('PYTHONPATH')])))
+    commands = {
+        'import': ['-c', 'import batch_curation'],
+        'help': [batch_curation, '--help'],
+        'bc_prep_help': [bc_prep, '--help'],
+        'small_batch': [batch_curation, '-b', work_dir, '-t',
+            inputs['template'], '-m', 'cold_mapping.csv', '-z', inputs['zip'],
+            '-o', 'cold_output.zip'],
+    }
+    repeats = params.get('cold_repeats', 5)
+    results = {}
+    for key, args in commands.items():
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + args, cwd=work_dir, env=env,
+                check=True, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        results[key] = best
+    return results, 0, len(commands)
+
+STAGES = {
+    'Parser.parse': stage_parse,
+    'update_template': stage_update_template,
+    'prepare_batch_curation': stage_prepare,
+    'batch_curation.run': stage_run,
+    'cold_start': stage_cold_start,
+}
+
+def _stage_process(name, work_dir, inputs, params, results):
+    # stages write their logs and outputs into the work directory
+    os.chdir(work_dir)
+    times, nbytes, nitems = STAGES[name](work_dir, inputs, params)
+    # largest of this process and of its finished workers
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    results.put({'seconds': times, 'bytes': nbytes, 'items': nitems,
+        'peak_rss_mb': peak*scale/1024/1024})
+
+def run_stage(name, work_dir, inputs, params):
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=_stage_process,
+        args=(name, work_dir, inputs, params, results))
+    process.start()
+    # the traceback of a failed stage is printed by the child, which exits
+    # without a result
+    result = None
+    while result is None:
+        try:
+            result = results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                # the result may have been queued right before the exit
+                try:
+                    result = results.get(timeout=1)
+                except queue.Empty:
+                    break
+    process.join()
+    if result is None:
+        raise Exception(f'Stage {name} failed with exit code \
+{process.exitcode}.')
+    total = sum(result['seconds'].values())
+    result['items_per_s'] = result['items']/total if total else None
+    result['mb_per_s'] = result['bytes']/1024/1024/total if total else None
+    return result
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+            capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def compare(results, baseline, threshold):
+    '''
+    Print the change of every timing against baseline and return the stages
+    that are slower by more than threshold.
+    '''
+    regressions = []
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        for key, seconds in result['seconds'].items():
+            base = baseline[stage]['seconds'].get(key)
+            if not base:
+                continue
+            ratio = seconds/base
+            flag = ' REGRESSION' if ratio > 1 + threshold else ''
+            print(f'{stage} [{key}]: {base:.3f}s -> {seconds:.3f}s (x{ratio:.2f}){flag}')
+            if flag:
+                regressions.append(f'{stage} [{key}]')
+    return regressions
+
+def readOptions(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Synthetic-scale benchmarks of the batch curation pipeline.")
+    parser.add_argument("--preset", default='small', choices=sorted(PRESETS), help="Scale of the synthetic inputs. Default to small.")
+    for key in PRESETS['small']:
+        parser.add_argument(f"--{key}", type=int, help=f"[Optional] Override {key} of the preset.")
+    parser.add_argument("--workers", default=1, type=int, help="Number of worker processes of batch_curation.run. Default to 1.")
+    parser.add_argument("--stream", default=False, action='store_true', help="Use the streaming output mode of batch_curation.run.")
+    parser.add_argument("--stages", nargs='+', default=list(STAGES), choices=list(STAGES), help="Stages to run. Default to all.")
+    parser.add_argument("--work_dir", help="[Optional] Directory for the synthetic inputs, kept after the run. Default to a temporary directory.")
+    parser.add_argument("--json_out", help="[Optional] File name to save the results as JSON.")
+    parser.add_argument("--compare", help="[Optional] JSON results of a previous run to compare with.")
+    parser.add_argument("--threshold", default=0.2, type=float, help="Relative slowdown reported as regression by --compare. Default to 0.2.")
+    return parser.parse_args(args)
+
+def main(opts):
+    params = dict(PRESETS[opts.preset])
+    for key in PRESETS['small']:
+        if getattr(opts, key) is not None:
+            params[key] = getattr(opts, key)
+    params['workers'] = opts.workers
+    params['stream'] = opts.stream
+    with tempfile.TemporaryDirectory() as td:
+        work_dir = os.path.abspath(opts.work_dir or td)
+        os.makedirs(work_dir, exist_ok=True)
+        start = time.perf_counter()
+        inputs = generate(work_dir, params)
+        print(f'Synthetic inputs generated in {time.perf_counter()-start:.1f}s.')
+        results = {}
+        for stage in opts.stages:
+            results[stage] = run_stage(stage, work_dir, inputs, params)
+            print(f'{stage}: ' + ', '.join(f'{k} {v:.3f}s'
+                for k,v in results[stage]['seconds'].items()) +
+                f', peak RSS {results[stage]["peak_rss_mb"]:.0f} MB')
+    report = {
+        'meta': {'preset': opts.preset, 'params': params,
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'git_revision': git_revision(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')},
+        'results': results,
+    }
+    if opts.json_out:
+        with open(opts.json_out, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f'Results saved as {opts.json_out}.')
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, opts.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(readOptions()))
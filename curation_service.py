@@ -0,0 +1,307 @@
+## Long-lived batch curation engine and watch-folder service
+
+# -------------------------------------------- file os and other general lib
+import os
+import time
+import queue
+import threading
+# -------------------------------------------- for data I/O
+from batch_curation import batch_curation, load_engines, WorkerPool
+from concurrent.futures.process import BrokenProcessPool
+from inp_parser.cache import ParseCache
+from manifest import file_digest
+# -------------------------------------------- for command line arguments
+import argparse
+import sys
+# -------------------------------------------- logging
+import logging
+
+# file extensions of the mapping in a dropped batch
+MAPPING_EXTENSIONS = ('.xlsx', '.csv', '.tsv')
+# default file name of the output zip in a dropped batch, excluded from the
+# inputs of the batch
+OUTPUT_NAME = 'batch_template_output'
+# written into a dropped batch once processed
+DONE_MARKER = 'batch_curation.done'
+FAILED_MARKER = 'batch_curation.failed'
+
+class CurationEngine():
+    def __init__(self, master_template, parse_inp=False, engine='openpyxl',
+        inp_cache_dir=None, inp_cache_size_mb=512, **curation_options):
+        '''
+        Run many batches in this process against the same master template.
+        The compiled master template and the inp_parser cache are kept
+        between batches, every batch logs into its own
+        {base_dir}/batch_curation.log. With workers > 1 the worker processes
+        are started with the first batch and kept until close.
+
+        Input:
+        :param master_template: path of the master template. *.xlsx
+        :type master_template: str
+
+        :param parse_inp: call inp_parser and modify/overwrite template if True
+        :type parse_inp: bool
+
+        :param engine: templating engine, see batch_curation
+        :type engine: str
+
+        :param inp_cache_dir: directory of the on-disk cache of inp_parser
+            outputs, shared with the worker processes and across restarts
+        :type inp_cache_dir: str or NoneType
+
+        :param inp_cache_size_mb: size cap of the on-disk inp_parser cache,
+            in MB
+        :type inp_cache_size_mb: int
+
+        :param curation_options: default options of every batch, e.g. workers,
+            stream_output, see batch_curation
+        :type curation_options: dict
+        '''
+        self.master_template = os.path.abspath(master_template)
+        self.parse_inp = parse_inp
+        self.engine = engine
+        self.curation_options = curation_options
+        self.inp_cache = ParseCache(inp_cache_dir,
+            max_bytes=int(inp_cache_size_mb*1024*1024))
+        # (engine, path) -> (digest, compiled template), see batch_curation
+        self.templates = {}
+        self.batches = 0
+        # worker processes shared by the batches, see WorkerPool
+        self.worker_pool = None
+        # compile the master template before the first batch arrives
+        engines = load_engines()
+        if engine not in engines:
+            raise Exception(f'Unknown templating engine {engine}, use one of \
+{", ".join(engines)}.')
+        self.templates[(engine, self.master_template)] = (
+            file_digest(self.master_template), engines[engine](
+            self.master_template))
+
+    def curate(self, base_dir, mapping_tabular, zipped_datafiles,
+        output_zip=None, **curation_options):
+        '''
+        Generate the output zip of one batch, options override the defaults
+        of the engine.
+
+        Output:
+        :return: the batch_curation instance of the batch
+        :rtype: batch_curation
+        '''
+        options = dict(self.curation_options, **curation_options)
+        if options.get('workers', 1) > 1 and self.worker_pool is None:
+            self.worker_pool = WorkerPool(options['workers'],
+                self.master_template, self.engine)
+        # a log file per batch instead of the file of the first batch
+        handler = logging.FileHandler(os.path.join(base_dir,
+            'batch_curation.log'))
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s',
+            datefmt='%d-%b-%y %H:%M:%S'))
+        root = logging.getLogger()
+        root.addHandler(handler)
+        root.setLevel(logging.INFO)
+        try:
+            bc = batch_curation(base_dir=base_dir,
+                master_template=self.master_template,
+                mapping_tabular=mapping_tabular,
+                zipped_datafiles=zipped_datafiles, parse_inp=self.parse_inp,
+                output_zip=output_zip, engine=self.engine,
+                inp_cache=self.inp_cache, templates=self.templates,
+                worker_pool=self.worker_pool if options.get('workers', 1) > 1
+                else None, **options)
+        except BrokenProcessPool:
+            # a worker died, start new ones with the next batch
+            self.close()
+            raise
+        finally:
+            root.removeHandler(handler)
+            handler.close()
+        self.batches += 1
+        return bc
+
+    def close(self):
+        # stop the worker processes
+        if self.worker_pool is not None:
+            self.worker_pool.shutdown()
+            self.worker_pool = None
+
+    def watch(self, watch_dir, poll_seconds=5, queue_size=4, once=False,
+        output_zip=None):
+        '''
+        Process the batches dropped into watch_dir as they arrive. A batch is
+        a folder in watch_dir holding one mapping (.xlsx/.csv/.tsv) and one
+        zip of datafiles, picked up once its files stop changing between two
+        polls. The output zip is written into the folder, followed by a
+        batch_curation.done marker, or batch_curation.failed with the error.
+
+        Input:
+        :param poll_seconds: seconds between two scans of watch_dir
+        :type poll_seconds: float
+
+        :param queue_size: number of complete batches waiting to be processed,
+            watch_dir is not scanned while the queue is full
+        :type queue_size: int
+
+        :param once: return once the batches present in watch_dir are
+            processed instead of watching forever
+        :type once: bool
+        '''
+        requests = queue.Queue(max(1, queue_size))
+        stop = threading.Event()
+        poller = threading.Thread(target=self.poll, daemon=True,
+            args=(watch_dir, poll_seconds, requests, stop, once))
+        poller.start()
+        logging.info(f'Watching {watch_dir} for batches.')
+        try:
+            while True:
+                try:
+                    batch = requests.get(timeout=max(poll_seconds, 1))
+                except queue.Empty:
+                    # the poller only stops after queuing the end marker
+                    if not poller.is_alive() and requests.empty():
+                        logging.error(f'Scanning {watch_dir} stopped.')
+                        raise Exception(f'Scanning {watch_dir} stopped, see \
+the log for the error.')
+                    continue
+                # end of the batches present, only queued with once
+                if batch is None:
+                    break
+                self.process_drop(*batch, output_zip=output_zip)
+        finally:
+            stop.set()
+            self.close()
+
+    def poll(self, watch_dir, poll_seconds, requests, stop, once):
+        try:
+            self.scan(watch_dir, poll_seconds, requests, stop, once)
+        except Exception:
+            # watch raises once the queue is drained
+            logging.exception(f'Scanning {watch_dir} failed.')
+            raise
+
+    def scan(self, watch_dir, poll_seconds, requests, stop, once):
+        # folder -> file sizes and mtimes at the previous scan
+        previous = {}
+        queued = set()
+        while not stop.is_set():
+            settling = False
+            try:
+                folders = sorted(os.listdir(watch_dir))
+            except OSError as e:
+                logging.exception(f'Cannot list {watch_dir}.')
+                print(f'Warning: cannot list {watch_dir}: {e}')
+                folders = []
+                settling = True
+            for folder in folders:
+                folder = os.path.join(watch_dir, folder)
+                if folder in queued or not os.path.isdir(folder) or \
+                    os.path.exists(os.path.join(folder, DONE_MARKER)) or \
+                    os.path.exists(os.path.join(folder, FAILED_MARKER)):
+                    continue
+                try:
+                    inputs = find_inputs(folder)
+                    signature = folder_signature(folder)
+                except OSError as e:
+                    # files removed during the scan, e.g. lock and temporary
+                    # files, or the whole folder, check again at the next scan
+                    logging.info(f'{folder} changed during the scan: {e}')
+                    previous.pop(folder, None)
+                    settling = True
+                    continue
+                if inputs is None:
+                    continue
+                if previous.get(folder) != signature:
+                    # still being copied, check again at the next scan
+                    previous[folder] = signature
+                    settling = True
+                    continue
+                queued.add(folder)
+                # blocks while the queue is full
+                requests.put((folder,) + inputs)
+            if once and not settling:
+                requests.put(None)
+                return
+            stop.wait(poll_seconds)
+
+    def process_drop(self, folder, mapping_tabular, zipped_datafiles,
+        output_zip=None):
+        start = time.perf_counter()
+        print(f'Processing the batch in {folder}.')
+        try:
+            bc = self.curate(folder, mapping_tabular, zipped_datafiles,
+                output_zip=output_zip)
+        except Exception as e:
+            print(f'Warning: batch in {folder} failed: {e}')
+            logging.exception(f'Batch in {folder} failed.')
+            with open(os.path.join(folder, FAILED_MARKER), 'w') as f:
+                f.write(f'{type(e).__name__}: {e}\n')
+            return None
+        with open(os.path.join(folder, DONE_MARKER), 'w') as f:
+            f.write(f'{bc.output_zip}\n')
+        logging.info(f'Batch in {folder} done in \
+{time.perf_counter()-start:.1f} s, {bc.nsamples} samples.')
+        return bc
+
+def find_inputs(folder):
+    '''
+    File names of the mapping and the zipped datafiles of a dropped batch, or
+    None if the folder does not hold exactly one of each.
+    '''
+    mappings = []
+    zips = []
+    for file in os.listdir(folder):
+        name, ext = os.path.splitext(file)
+        ext = ext.lower()
+        # outputs of a previous attempt and lock files of open workbooks
+        if name.startswith(OUTPUT_NAME) or file.startswith('~$') or \
+            not os.path.isfile(os.path.join(folder, file)):
+            continue
+        if ext in MAPPING_EXTENSIONS:
+            mappings.append(file)
+        elif ext == '.zip':
+            zips.append(file)
+    if len(mappings) != 1 or len(zips) != 1:
+        return None
+    return mappings[0], zips[0]
+
+def folder_signature(folder):
+    signature = []
+    for file in sorted(os.listdir(folder)):
+        stat = os.stat(os.path.join(folder, file))
+        signature.append((file, stat.st_size, stat.st_mtime_ns))
+    return signature
+
+
+def readOptions(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Watch a folder and generate the batch curation output of every batch dropped into it.")
+    parser.add_argument("-d", "--watch_dir", required=True, help="Type the folder watched for batches. Every batch is a folder holding one mapping tabular file and one zip file of appendix data files.")
+    parser.add_argument("-t", "--master_template", required=True, help="Type the path of your filled master template.")
+    parser.add_argument("-o", "--output_zip", help="[Optional] Type the file name for the output zip file in every batch folder. Default to be 'batch_template_output.zip'")
+    parser.add_argument("-p", "--parse_inp", dest='parse_inp', default=False, action='store_true', help="Use this argument to enable inp parsing during batch curation. The corresponding cells in the template will be overwritten.")
+    parser.add_argument("-w", "--workers", default=1, type=int, help="[Optional] Type the number of worker processes used to generate the samples. Default to 1.")
+    parser.add_argument("-s", "--stream_output", dest='stream_output', default=False, action='store_true', help="Use this argument to stream the samples straight into the output zip file without staging folders on disk.")
+    parser.add_argument("-e", "--engine", default='openpyxl', choices=['openpyxl', 'xml'], help="[Optional] Type the templating engine. Default to openpyxl.")
+    parser.add_argument("--inp_cache_dir", help="[Optional] Type the directory of the on-disk cache of inp parser outputs, reused across batches and restarts.")
+    parser.add_argument("--inp_cache_size_mb", default=512, type=float, help="[Optional] Type the size cap in MB of the on-disk inp parser cache. Default to 512.")
+    parser.add_argument("--poll_seconds", default=5, type=float, help="[Optional] Type the seconds between two scans of the watched folder. Default to 5.")
+    parser.add_argument("--queue_size", default=4, type=int, help="[Optional] Type the number of complete batches waiting to be processed. Default to 4.")
+    parser.add_argument("--once", dest='once', default=False, action='store_true', help="Use this argument to stop once the batches already in the watched folder are processed.")
+    opts = parser.parse_args(args)
+    return opts
+
+# Command line operation
+if __name__ == '__main__':
+    options = readOptions(sys.argv[1:])
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(message)s',
+                        datefmt='%d-%b-%y %H:%M:%S')
+    engine = CurationEngine(options.master_template,
+        parse_inp=options.parse_inp, engine=options.engine,
+        inp_cache_dir=options.inp_cache_dir,
+        inp_cache_size_mb=options.inp_cache_size_mb, workers=options.workers,
+        stream_output=options.stream_output)
+    try:
+        engine.watch(options.watch_dir, poll_seconds=options.poll_seconds,
+            queue_size=options.queue_size, once=options.once,
+            output_zip=options.output_zip)
+    except KeyboardInterrupt:
+        print(f'Stopped after {engine.batches} batches.')
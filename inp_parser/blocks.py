@@ -0,0 +1,78 @@
+import warnings
+
+import numpy as np
+
+# size of the pieces a large block of value rows is parsed in, in bytes
+BLOCK_SIZE = 16*1024*1024
+
+def parse_block(data):
+    '''
+    Parse comma separated value rows into a 2D float array in one call to
+    numpy instead of one Python float per value.
+    Rows continued on the next line (trailing comma) or of different length
+    are parsed row by row, missing values are nan.
+
+    Input:
+    :param data: value rows separated by line breaks
+    :type data: str or bytes
+    '''
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', errors='replace')
+    data = data.strip()
+    if not data:
+        return np.empty((0, 0))
+    first = data.split('\n', 1)[0].rstrip()
+    if not first.endswith(','):
+        ncols = first.count(',') + 1
+        nrows = data.count('\n') + 1
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            try:
+                values = np.fromstring(data.replace('\n', ','), sep=',')
+            except ValueError:
+                values = None
+        if values is not None and values.size == nrows*ncols:
+            return values.reshape(nrows, ncols)
+    return parse_rows(data)
+
+def parse_rows(data):
+    # slow path of parse_block
+    rows = []
+    row = ''
+    for line in data.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+        row += line
+        # a trailing comma continues the row on the next line
+        if not row.endswith(','):
+            rows.append([float(v) for v in row.split(',') if v.strip()])
+            row = ''
+    if row:
+        rows.append([float(v) for v in row.split(',') if v.strip()])
+    ncols = max((len(r) for r in rows), default=0)
+    table = np.full((len(rows), ncols), np.nan)
+    for i,r in enumerate(rows):
+        table[i,:len(r)] = r
+    return table
+
+def iter_blocks(buf, start, end, size=BLOCK_SIZE):
+    '''
+    Split buf[start:end] into pieces of about size bytes that end with a
+    complete row.
+    '''
+    while start < end:
+        stop = min(start + size, end)
+        pos = stop - 1
+        while stop < end:
+            eol = buf.find(b'\n', pos, end)
+            if eol == -1:
+                stop = end
+                break
+            stop = eol + 1
+            # keep rows continued on the next line (trailing comma) together
+            if not buf[max(start, eol-2):eol].rstrip().endswith(b','):
+                break
+            pos = stop
+        yield buf[start:stop]
+        start = stop
@@ -0,0 +1,156 @@
+import copy
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from inp_parser.version import PARSER_VERSION
+
+# chunk size used to hash inp files
+CHUNK_SIZE = 1024*1024
+
+class ParseCache():
+    def __init__(self, cache_dir=None, max_bytes=512*1024*1024,
+        max_entries=1024):
+        '''
+        Content-addressed cache of Parser.to_dict() outputs. Entries are keyed
+        by the sha256 of the inp file, the parser options that change the
+        output and PARSER_VERSION.
+
+        Input:
+        :param cache_dir: directory of the optional on-disk store, results
+            are only kept in this process if None
+        :type cache_dir: str or NoneType
+
+        :param max_bytes: size cap of the on-disk store, the least recently
+            used entries are removed first
+        :type max_bytes: int
+
+        :param max_entries: number of entries kept in this process
+        :type max_entries: int
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        # key -> parser output, in least recently used order
+        self.memory = OrderedDict()
+        # (path, size, mtime) -> sha256, avoids hashing a file twice
+        self.digests = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # the inp files of a sample are parsed by several threads
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def digest_file(self, path):
+        stat = os.stat(path)
+        file_id = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        return self.digest_fileobj(lambda: open(path, 'rb'), file_id)
+
+    def digest_fileobj(self, open_file, file_id=None):
+        '''
+        Input:
+        :param open_file: function that opens the inp file in binary mode
+        :type open_file: callable
+
+        :param file_id: hashable id of the file content, e.g. path, size and
+            modification time, used to skip hashing the same file again
+        :type file_id: tuple or NoneType
+        '''
+        if file_id is not None and file_id in self.digests:
+            return self.digests[file_id]
+        h = hashlib.sha256()
+        with open_file() as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                h.update(chunk)
+        if file_id is not None:
+            self.digests[file_id] = h.hexdigest()
+        return h.hexdigest()
+
+    def key(self, digest, skip=(), wanted=None):
+        options = json.dumps([PARSER_VERSION, digest, sorted(skip),
+            sorted(wanted) if wanted else None])
+        return hashlib.sha256(options.encode()).hexdigest()
+
+    def get(self, key):
+        '''
+        Return a copy of the cached parser output or None.
+        '''
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.hits += 1
+                self.memory.move_to_end(key)
+        if value is not None:
+            return copy.deepcopy(value)
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, key + '.json')
+            try:
+                with open(path, 'r') as f:
+                    value = json.load(f)
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                self.disk_hits += 1
+                # mark as recently used for the size based eviction, the file
+                # may have been evicted by another process meanwhile
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+                self.remember(key, value)
+                return copy.deepcopy(value)
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.remember(key, copy.deepcopy(value))
+        if self.cache_dir is None:
+            return
+        # write atomically, other processes may read the store concurrently
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.part')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp_path, os.path.join(self.cache_dir, key + '.json'))
+        self.evict()
+
+    def remember(self, key, value):
+        with self.lock:
+            self.memory[key] = value
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.json'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _,size,_ in entries)
+        # oldest entries first
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
@@ -1,9 +1,95 @@
+import mmap
+import os
+from itertools import zip_longest
+
+import numpy as np
+
+from inp_parser.blocks import parse_block, iter_blocks
+from inp_parser.version import PARSER_VERSION
+
+# chunk size used to count value rows in bulk
+CHUNK_SIZE = 64*1024*1024
+
+# number of value rows collected before they are parsed into an array
+BLOCK_ROWS = 100000
+
+# keyword -> section class, filled by register_section
+SECTION_HANDLERS = {}
+
+def keyword_key(row):
+    '''
+    Lookup key of the keyword of a header row, e.g.
+    '*Steady State Dynamics, direct' -> '*steady state dynamics'.
+    '''
+    return ' '.join(row.split(',')[0].lower().split())
+
+def register_section(*keywords):
+    '''
+    Class decorator making a Section subclass the handler of keywords, e.g.
+    @register_section('*Material'). Keywords are case-insensitive, a keyword
+    registered again replaces the previous handler.
+    '''
+    def register(cls):
+        for keyword in keywords:
+            SECTION_HANDLERS[keyword_key(keyword)] = cls
+        return cls
+    return register
+
+def merge_outputs(outputs):
+    '''
+    Merge the Parser.to_dict() outputs of the inp files of a sample. Rows
+    named in the additive attribute of a section class, e.g. the number of
+    elements of a model split over several inp files, are summed. Every other
+    row is taken from the first output that has it, so the first inp file
+    wins.
+    '''
+    additive = set()
+    for cls in set(SECTION_HANDLERS.values()):
+        additive.update(cls.additive)
+    merged = {}
+    for output in outputs:
+        for key, values in output.items():
+            if key not in merged:
+                merged[key] = list(values)
+            elif key in additive:
+                merged[key] = [add_counts(a, b)
+                    for a,b in zip_longest(merged[key], values)]
+    return merged
+
+def add_counts(a, b):
+    # sum numbers, keep the first of anything else, e.g. labels
+    numbers = (int, float, np.integer, np.floating)
+    if isinstance(a, numbers) and isinstance(b, numbers) and \
+        not isinstance(a, bool) and not isinstance(b, bool):
+        return a + b
+    return a if a is not None else b
+
+def count_rows(buf, start, end):
+    '''
+    Count the rows in buf[start:end] without building a string for each row.
+    '''
+    nrows = 0
+    for i in range(start, end, CHUNK_SIZE):
+        nrows += buf[i:min(i+CHUNK_SIZE, end)].count(b'\n')
+    # last row of the file without a line break
+    if end > start and buf[end-1:end] != b'\n':
+        nrows += 1
+    return nrows
+
 class Section():
+    # rows of to_dict() summed over the inp files of a sample, see
+    # merge_outputs, within a file the last section wins
+    additive = ()
+
     def __init__(self, row):
         self.name = ''
         self.attr = {}
         self.value = {'raw':[]}
         self.nrows = 0
+        # keep a copy of the raw value rows, only row counts are kept if False
+        self.keep_raw = True
+        # parse numeric tables into numpy arrays, see TableSection
+        self.arrays = False
         self.parse_header(row)
 
     def parse_header(self, header_row):
@@ -34,9 +120,34 @@ more than once for {self.name}')
         print(f'value: {self.value.keys()}')
 
     def update(self, row):
-        self.value['raw'].append(row)
+        if self.keep_raw:
+            self.value['raw'].append(row)
         self.nrows += 1
 
+    def update_block(self, buf, start, end):
+        '''
+        Update with all value rows in buf[start:end] at once.
+        Sections that only need the row count never decode the rows.
+        '''
+        if type(self).update is Section.update and not self.keep_raw:
+            self.nrows += count_rows(buf, start, end)
+            return
+        rows = buf[start:end].decode('utf-8', errors='replace').split('\n')
+        # the block ends with a line break except at the end of the file
+        if rows[-1] == '':
+            rows.pop()
+            rows = [row + '\n' for row in rows]
+        else:
+            rows = [row + '\n' for row in rows[:-1]] + rows[-1:]
+        for row in rows:
+            self.update(row)
+
+    def finalize(self):
+        '''
+        Called once after the last value row of the section has been read.
+        '''
+        return
+
     def __len__(self):
         return 1 if self.name else 0
 
@@ -48,7 +159,102 @@ more than once for {self.name}')
         '''
         return {}
 
-class Element(Section):
+class TableSection(Section):
+    '''
+    Section whose value rows form a numeric table. With arrays=True the rows
+    are parsed in bulk into float arrays instead of one row at a time. The
+    table is kept in value['table'] unless keep_raw is False, the running
+    statistics collected by reduce are always kept.
+    '''
+    def __init__(self, row):
+        super().__init__(row)
+        # rows waiting to be parsed and parsed pieces of the table
+        self.pending = []
+        self.tables = []
+
+    # overwrite the update method
+    def update(self, row):
+        if not self.arrays:
+            return super().update(row)
+        self.nrows += 1
+        self.pending.append(row)
+        if len(self.pending) >= BLOCK_ROWS:
+            self.flush()
+
+    # overwrite the update_block method
+    def update_block(self, buf, start, end):
+        if not self.arrays:
+            if not self.keep_raw:
+                self.nrows += count_rows(buf, start, end)
+                return
+            return super().update_block(buf, start, end)
+        self.nrows += count_rows(buf, start, end)
+        for block in iter_blocks(buf, start, end):
+            self.add_table(parse_block(block))
+
+    def flush(self):
+        if self.pending:
+            self.add_table(parse_block(''.join(self.pending)))
+            self.pending = []
+
+    def add_table(self, table):
+        if table.size == 0:
+            return
+        if self.keep_raw:
+            self.tables.append(table)
+        self.reduce(table)
+
+    def reduce(self, table):
+        '''
+        Update running statistics with a parsed piece of the table.
+        '''
+        return
+
+    # overwrite the finalize method
+    def finalize(self):
+        if not self.arrays:
+            return
+        self.flush()
+        if self.tables:
+            ncols = max(table.shape[1] for table in self.tables)
+            # pieces of rows of different length are padded with nan
+            self.value['table'] = np.concatenate([np.pad(table,
+                ((0,0),(0,ncols-table.shape[1])), constant_values=np.nan)
+                for table in self.tables])
+            self.tables = []
+
+@register_section('*Node')
+class Node(TableSection):
+    additive = ('Number of Nodes',)
+
+    # overwrite the reduce method
+    def reduce(self, table):
+        # bounding box of the node coordinates, first column is the node label
+        coords = table[:,1:]
+        bbox_min = np.nanmin(coords, axis=0)
+        bbox_max = np.nanmax(coords, axis=0)
+        if 'bbox_min' in self.value:
+            bbox_min = np.fmin(self.value['bbox_min'], bbox_min)
+            bbox_max = np.fmax(self.value['bbox_max'], bbox_max)
+        self.value['bbox_min'] = bbox_min
+        self.value['bbox_max'] = bbox_max
+
+    # overwrite the to_dict method
+    def to_dict(self):
+        return {'Number of Nodes': ['inserted by inp_parser', self.nrows]}
+
+@register_section('*Element')
+class Element(TableSection):
+    additive = ('Number of Elements',)
+
+    # overwrite the finalize method
+    def finalize(self):
+        super().finalize()
+        # element label and node labels
+        table = self.value.get('table')
+        if table is not None and not np.isnan(table).any():
+            self.value['table'] = table.astype(np.int64)
+
     # overwrite the to_dict method
     def to_dict(self):
         template = {}
@@ -60,6 +266,7 @@ class Element(Section):
                                                  self.attr['TYPE']]
         return template
 
+@register_section('*Steady State Dynamics')
 class SteadyStateDynamics(Section):
     # overwrite the update method
     def update(self, row):
@@ -84,6 +291,7 @@ class SteadyStateDynamics(Section):
                                                          self.value['num_freq']]
         return template
 
+@register_section('*Elastic')
 class Elastic(Section):
     def __init__(self, row):
         super().__init__(row)
@@ -97,28 +305,35 @@ class Elastic(Section):
         self.value['youngs_modulus'] = float(segs[0])
         self.value['poissons_ratio'] = float(segs[1])
 
+@register_section('*Density')
 class Density(Section):
     # overwrite the update method
     def update(self, row):
         self.value['density'] = float(row)
         self.nrows += 1
 
-class Viscoelastic(Section):
-    # overwrite the update method
-    def update(self, row):
-        self.nrows += 1
-        segs = row.split(',')
-        self.value['wg*_real'] = self.value.get('wg*_real',[])
-        self.value['wg*_real'].append(float(segs[0]))
-        self.value['wg*_imag'] = self.value.get('wg*_imag',[])
-        self.value['wg*_imag'].append(float(segs[1]))
-        self.value['wk*_real'] = self.value.get('wk*_real',[])
-        self.value['wk*_real'].append(float(segs[2]))
-        self.value['wk*_imag'] = self.value.get('wk*_imag',[])
-        self.value['wk*_imag'].append(float(segs[3]))
-        self.value['frequency'] = self.value.get('frequency',[])
-        self.value['frequency'].append(float(segs[4]))
+@register_section('*Viscoelastic')
+class Viscoelastic(TableSection):
+    def __init__(self, row):
+        super().__init__(row)
+        # the table is small and always parsed into arrays
+        self.arrays = True
+
+    # overwrite the add_table method, the table is kept even if not keep_raw
+    def add_table(self, table):
+        if table.size:
+            self.tables.append(table)
 
+    # overwrite the finalize method
+    def finalize(self):
+        super().finalize()
+        if 'table' in self.value:
+            table = self.value['table']
+            for i,key in enumerate(['wg*_real','wg*_imag','wk*_real',
+                'wk*_imag','frequency']):
+                self.value[key] = table[:,i]
+
+@register_section('*Boundary')
 class Boundary(Section):
     def __init__(self, row):
         super().__init__(row)
@@ -160,49 +375,140 @@ class Boundary(Section):
         #     # 'x', 'y', 'z', accessed by directions[i-1]
         #         template['Direction'].append(sign + directions[i-1])
         return template
-    
+
+@register_section('*Material')
+class Material(Section):
+    '''
+    Name of a material, its properties follow as *Elastic, *Density, ...
+    sections. The name keeps its case, unlike the attributes.
+    '''
+    def __init__(self, row):
+        super().__init__(row)
+        for seg in row.split(',')[1:]:
+            attr, _, val = seg.partition('=')
+            if attr.strip().upper() == 'NAME':
+                self.value['name'] = val.strip()
+
 class Parser():
     # by default skip *Equation
-    def __init__(self, inp_file, skip={'*Equation'}):
-        if not inp_file.lower().endswith('.inp'):
+    # inp_file can be a file name or a file object opened in text mode
+    # stream=True keeps memory flat for large meshes: raw value rows and
+    # comments are not stored, sections only keep counters, attributes and
+    # the values used by to_dict()
+    # fast=True scans a file on disk through mmap and jumps from one keyword
+    # row to the next, only the sections with values used by to_dict() look
+    # at their rows; wanted is an optional set of keywords, e.g. {'*Element'},
+    # to parse only those sections, the others are jumped over. The whole
+    # file is still scanned, a keyword may repeat and the last section wins.
+    # File objects are always parsed row by row.
+    # arrays=True parses *Node and *Element tables into numpy arrays, giving
+    # node bounding boxes and element connectivity. *Viscoelastic tables are
+    # always parsed into arrays.
+    def __init__(self, inp_file, skip={'*Equation'}, stream=False, fast=False,
+        wanted=None, arrays=False):
+        if isinstance(inp_file, str) and not inp_file.lower().endswith('.inp'):
             inp_file += '.inp'
         self.skip = skip
+        self.stream = stream
+        self.fast = fast
+        self.arrays = arrays
+        self.wanted = {kw.lower() for kw in wanted} if wanted else None
         self.sections = []
         self.comments = []
+        self.ncomments = 0
         self.parse(inp_file)
 
     def parse(self, inp_file):
         self.prev_section = Section('')
+        if not isinstance(inp_file, str):
+            self.parse_rows(inp_file)
+            return
+        if self.fast:
+            self.scan(inp_file)
+            return
         with open(inp_file, 'r') as f:
-            for row in f:
-                # comment rows
-                if row.startswith('**'):
+            self.parse_rows(f)
+        return
+
+    def new_section(self, row):
+        # pick the section class registered for the keyword of the header row
+        section = SECTION_HANDLERS.get(keyword_key(row), Section)(row)
+        if self.stream:
+            section.keep_raw = False
+        if self.arrays:
+            section.arrays = True
+        return section
+
+    def parse_rows(self, f):
+        for row in f:
+            # comment rows
+            if row.startswith('**'):
+                self.ncomments += 1
+                if not self.stream:
                     self.comments.append(row)
-                # header rows
-                elif row.startswith('*'):
-                    if self.prev_section and\
-                    self.prev_section.name not in self.skip:
-                        # save prev_section
-                        self.sections.append(self.prev_section)
-                    # update prev_section with current row
-                    if row.lower().startswith('*steady state dynamics'):
-                        self.prev_section = SteadyStateDynamics(row)
-                    elif row.lower().startswith('*elastic'):
-                        self.prev_section = Elastic(row)
-                    elif row.lower().startswith('*density'):
-                        self.prev_section = Density(row)
-                    elif row.lower().startswith('*boundary'):
-                        self.prev_section = Boundary(row)
-                    elif row.lower().startswith('*viscoelastic'):
-                        self.prev_section = Viscoelastic(row)
-                    elif row.lower().startswith('*element') and \
-                    not row.lower().startswith('*element output'):
-                        self.prev_section = Element(row)
-                    else:
-                        self.prev_section = Section(row)
-                # value rows
-                else:
-                    self.prev_section.update(row)
+            # header rows
+            elif row.startswith('*'):
+                self.prev_section.finalize()
+                if self.prev_section and\
+                self.prev_section.name not in self.skip:
+                    # save prev_section
+                    self.sections.append(self.prev_section)
+                # update prev_section with current row
+                self.prev_section = self.new_section(row)
+            # value rows
+            else:
+                self.prev_section.update(row)
+        self.prev_section.finalize()
+        return
+
+    def scan(self, inp_file):
+        if os.path.getsize(inp_file) == 0:
+            return
+        with open(inp_file, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            self.scan_buffer(buf)
+        return
+
+    def scan_buffer(self, buf):
+        section = None
+        # start of the value rows of the current section
+        pos = 0
+        size = len(buf)
+        while pos < size:
+            # next row starting with '*'
+            if buf[pos:pos+1] == b'*':
+                star = pos
+            else:
+                star = buf.find(b'\n*', pos)
+                star = size if star == -1 else star + 1
+            # value rows between pos and the next keyword or comment row
+            if section is not None and star > pos:
+                section.update_block(buf, pos, star)
+            if star == size:
+                if section is not None:
+                    section.finalize()
+                break
+            eol = buf.find(b'\n', star)
+            eol = size if eol == -1 else eol + 1
+            row = buf[star:eol].decode('utf-8', errors='replace')
+            pos = eol
+            # comment rows
+            if row.startswith('**'):
+                self.ncomments += 1
+                if not self.stream:
+                    self.comments.append(row)
+                continue
+            # header rows, save the finished section
+            if section is not None:
+                section.finalize()
+                self.sections.append(section)
+            section = self.new_section(row)
+            # sections that are skipped, not wanted or that go into the
+            # template as nothing but their name are not looked at
+            if section.name in self.skip or \
+            (self.wanted is not None and section.name.lower() not in self.wanted) or \
+            type(section) is Section:
+                section = None
         return
 
     def view(self):
@@ -223,6 +529,12 @@ class Parser():
             template.update(sec.to_dict())
         return template
 
+    @property
+    def materials(self):
+        # names of the *Material sections, in the order of the file
+        return [sec.value['name'] for sec in self.sections
+            if isinstance(sec, Material) and 'name' in sec.value]
+
     def __getitem__(self, index):
         return self.sections[index]
 
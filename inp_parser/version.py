@@ -0,0 +1,3 @@
+# bump whenever the output of Parser.to_dict() changes, cached results of
+# older versions are then ignored
+PARSER_VERSION = '5'
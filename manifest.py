@@ -0,0 +1,160 @@
+## Manifest of the inputs of each generated sample, used by batch_curation to
+## rebuild only the samples whose inputs changed
+
+# -------------------------------------------- file os and other general lib
+import os
+import hashlib
+import json
+import tempfile
+import zipfile
+# -------------------------------------------- logging
+import logging
+
+# bump whenever the layout of the manifest changes
+MANIFEST_VERSION = 2
+
+# chunk size used to hash files
+CHUNK_SIZE = 1024*1024
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def row_digest(sample_mapping):
+    '''
+    Hash of a row in the mapping, placeholders and values with their types,
+    e.g. 1 and '1' are written as different cells.
+    '''
+    row = [[str(k), type(v).__name__, repr(v)] for k,v in sample_mapping.items()]
+    return hashlib.sha256(json.dumps(row).encode()).hexdigest()
+
+class Manifest():
+    def __init__(self, path, template_digest, options):
+        '''
+        Input:
+        :param path: file name of the manifest. *.json
+        :type path: str
+
+        :param template_digest: hash of the master template
+        :type template_digest: str
+
+        :param options: options of the run that change the generated samples
+        :type options: dict
+        '''
+        self.path = path
+        self.template_digest = template_digest
+        self.options_digest = hashlib.sha256(
+            json.dumps(options, sort_keys=True).encode()).hexdigest()
+        # sample id -> entry of the previous and of the current run
+        self.previous = self.load()
+        self.samples = {}
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('version') != MANIFEST_VERSION:
+            return {}
+        return data.get('samples', {})
+
+    def entry(self, sample_mapping, appendix_infos):
+        '''
+        Input:
+        :param sample_mapping: a row of the mapping
+        :type sample_mapping: mapping_reader.MappingRow
+
+        :param appendix_infos: ZipInfo of every appendix file of the sample
+        :type appendix_infos: list
+        '''
+        return {
+            'row': row_digest(sample_mapping),
+            'template': self.template_digest,
+            'options': self.options_digest,
+            # CRC and size recorded in the zipped datafiles
+            'appendix': {info.filename: f'{info.CRC:08x}-{info.file_size}'
+                for info in appendix_infos},
+        }
+
+    def add(self, sample_id, entry, archive):
+        entry = dict(entry)
+        # archive holding the sample, relative to the manifest
+        entry['archive'] = os.path.basename(archive)
+        self.samples[str(sample_id)] = entry
+
+    def set_archive(self, sample_id, archive):
+        # the sample was written into another archive, e.g. a shard
+        self.samples[str(sample_id)]['archive'] = os.path.basename(archive)
+
+    def set_parser_out(self, sample_id, parser_out):
+        # inp_parser output of the sample, checked again by --verify
+        self.samples[str(sample_id)]['parser_out'] = parser_out
+
+    def carry_parser_out(self, sample_id):
+        # a carried sample keeps the inp_parser output of the previous run
+        previous = self.previous.get(str(sample_id), {})
+        if 'parser_out' in previous:
+            self.set_parser_out(sample_id, previous['parser_out'])
+
+    def parser_outs(self):
+        '''
+        Output:
+        :return: sample id -> recorded inp_parser output
+        :rtype: dict
+        '''
+        return {sample_id: entry['parser_out']
+            for sample_id, entry in self.samples.items()
+            if 'parser_out' in entry}
+
+    def carry_source(self, sample_id, entry):
+        '''
+        Return the previous archive holding an up-to-date copy of the sample,
+        or None if the sample has to be generated again.
+        '''
+        previous = self.previous.get(str(sample_id))
+        if previous is None:
+            return None
+        previous = dict(previous)
+        previous.pop('parser_out', None)
+        archive = previous.pop('archive', None)
+        if previous != entry or archive is None:
+            return None
+        archive = os.path.join(os.path.dirname(self.path), archive)
+        return archive if os.path.exists(archive) else None
+
+    def save(self):
+        data = {'version': MANIFEST_VERSION, 'samples': self.samples}
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path),
+            suffix='.part')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp_path, self.path)
+        logging.info(f'Manifest saved as {self.path}.')
+
+class PreviousOutput():
+    def __init__(self):
+        '''
+        Read access to the sample folders of previous output archives. Each
+        archive is indexed by sample folder and kept open until close.
+        '''
+        # archive path -> (ZipFile, {sample id: [ZipInfo, ...]})
+        self.archives = {}
+
+    def members(self, archive, sample_id):
+        if archive not in self.archives:
+            zf = zipfile.ZipFile(archive)
+            index = {}
+            for info in zf.infolist():
+                index.setdefault(info.filename.split('/')[0], []).append(info)
+            self.archives[archive] = (zf, index)
+        zf, index = self.archives[archive]
+        return zf, index.get(str(sample_id), [])
+
+    def close(self):
+        for zf, index in self.archives.values():
+            zf.close()
+        self.archives = {}
@@ -0,0 +1,276 @@
+## Streaming reader of the sample-variable mapping used by batch_curation
+
+# -------------------------------------------- file os and other general lib
+import os
+import re
+import math
+# -------------------------------------------- for data I/O
+# openpyxl is only imported for xlsx mappings, pandas is not needed
+import csv
+# -------------------------------------------- logging
+import logging
+
+# csv/tsv cells read as empty, the default na_values of pandas.read_csv
+NA_VALUES = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN',
+    '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'n/a',
+    'nan', 'null'}
+TRUE_VALUES = {'True', 'TRUE', 'true'}
+FALSE_VALUES = {'False', 'FALSE', 'false'}
+INT_RE = re.compile(r'[+-]?\d+')
+FLOAT_RE = re.compile(r'[+-]?(?:(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?|inf|Inf|INF|infinity|Infinity)')
+
+class MappingRow():
+    '''
+    A row of the mapping. Values are looked up by placeholder, e.g.
+    row['$sample_id'], or by position, e.g. row[0] for the sample id, and
+    iterating over the row gives the values like a pandas.Series. Empty
+    cells are None.
+    '''
+    __slots__ = ('columns', 'index', 'values')
+
+    def __init__(self, columns, index, values):
+        # columns and index are shared by all rows of a mapping
+        self.columns = columns
+        self.index = index
+        self.values = values
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self.values[key]
+        return self.values[self.index[key]]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def items(self):
+        return zip(self.columns, self.values)
+
+    def __getstate__(self):
+        return (self.columns, self.values)
+
+    def __setstate__(self, state):
+        self.columns, self.values = state
+        self.index = {col: i for i,col in enumerate(self.columns)}
+
+    def __repr__(self):
+        return f'MappingRow({dict(self.items())})'
+
+class MappingReader():
+    def __init__(self, mapping_tabular):
+        '''
+        Read the mapping one row at a time. csv and tsv files are read with
+        the csv module, the type of every column is inferred like
+        pandas.read_csv does in a first pass, see column_types. xlsx files are read with the read-only
+        openpyxl reader. Only the header is read here, every iteration reads
+        the file again.
+
+        Input:
+        :param mapping_tabular: path of the mapping tabular file.
+            *.xlsx/*.csv/*.tsv
+        :type mapping_tabular: str
+        '''
+        self.path = mapping_tabular
+        # csv/tsv column types, inferred on the first iteration
+        self.types = None
+        self.file_ext = os.path.splitext(mapping_tabular)[1].lower()
+        if self.file_ext not in ('.xlsx', '.csv', '.tsv'):
+            logging.error('The mapping file must be a .xlsx/.csv/.tsv file.')
+            raise Exception('The mapping file must be a .xlsx/.csv/.tsv file.')
+        self.columns = tuple(dedupe_columns(self.read_header()))
+        self.index = {col: i for i,col in enumerate(self.columns)}
+
+    def read_header(self):
+        if self.file_ext == '.xlsx':
+            import openpyxl
+            wb = openpyxl.load_workbook(self.path, read_only=True,
+                data_only=True)
+            try:
+                header = next(wb.worksheets[0].iter_rows(values_only=True), ())
+            finally:
+                wb.close()
+            header = list(header)
+            # trailing empty cells are not columns
+            while header and header[-1] is None:
+                header.pop()
+            return [f'Unnamed: {i}' if col is None else col
+                for i,col in enumerate(header)]
+        with self.open_csv() as f:
+            header = next(csv.reader(f, delimiter=self.sep), [])
+        return [col if col else f'Unnamed: {i}' for i,col in enumerate(header)]
+
+    def open_csv(self):
+        # utf-8-sig drops the byte order mark written by Excel
+        return open(self.path, newline='', encoding='utf-8-sig')
+
+    @property
+    def sep(self):
+        return '\t' if self.file_ext == '.tsv' else ','
+
+    def __iter__(self):
+        for values in self.iter_values():
+            yield MappingRow(self.columns, self.index, values)
+
+    def iter_values(self):
+        if self.file_ext == '.xlsx':
+            yield from self.iter_xlsx()
+            return
+        if self.types is None:
+            self.types = column_types(self.iter_text())
+        converters = [CONVERTERS[kind] for kind in self.types]
+        for row in self.iter_text():
+            yield [convert(v) for convert, v in zip(converters, row)]
+
+    def iter_text(self):
+        # rows of text cells, padded or cut to the columns of the header
+        ncols = len(self.columns)
+        with self.open_csv() as f:
+            rows = csv.reader(f, delimiter=self.sep)
+            next(rows, None)
+            for row in rows:
+                # blank lines are skipped, as in pandas.read_csv
+                if not row:
+                    continue
+                row = row[:ncols]
+                row += ['']*(ncols - len(row))
+                yield row
+
+    def iter_xlsx(self):
+        import openpyxl
+        wb = openpyxl.load_workbook(self.path, read_only=True, data_only=True)
+        try:
+            ws = wb.worksheets[0]
+            # the dimension recorded in the file may be wrong
+            ws.reset_dimensions()
+            ncols = len(self.columns)
+            rows = ws.iter_rows(min_row=2, values_only=True)
+            for values in rows:
+                values = list(values[:ncols])
+                # empty rows are skipped, as in pandas.read_excel
+                if all(v is None for v in values):
+                    continue
+                values += [None]*(ncols - len(values))
+                yield values
+        finally:
+            wb.close()
+
+    def nrows_hint(self):
+        '''
+        Number of rows for the progress bar, counting line breaks of csv/tsv
+        files and reading the dimension of xlsx files. May be off by a few.
+        '''
+        try:
+            if self.file_ext == '.xlsx':
+                import openpyxl
+                wb = openpyxl.load_workbook(self.path, read_only=True)
+                try:
+                    max_row = wb.worksheets[0].max_row
+                finally:
+                    wb.close()
+                return max_row - 1 if max_row else None
+            with open(self.path, 'rb') as f:
+                nrows = sum(chunk.count(b'\n')
+                    for chunk in iter(lambda: f.read(1024*1024), b''))
+            return max(nrows - 1, 0)
+        except OSError:
+            return None
+
+class FrameReader():
+    def __init__(self, df):
+        '''
+        Rows of a mapping already loaded as a DataFrame, e.g. by
+        bc_prep.prepare_batch_curation, with the interface of MappingReader.
+
+        Input:
+        :param df: the mapping, placeholders as columns
+        :type df: pandas.DataFrame
+        '''
+        self.df = df
+        self.columns = tuple(dedupe_columns(df.columns))
+        self.index = {col: i for i,col in enumerate(self.columns)}
+
+    def __iter__(self):
+        for values in self.df.itertuples(index=False, name=None):
+            yield MappingRow(self.columns, self.index,
+                [None if isinstance(v, float) and math.isnan(v) else v
+                for v in values])
+
+    def nrows_hint(self):
+        return len(self.df)
+
+def column_types(rows):
+    '''
+    Type of every csv/tsv column as pandas.read_csv infers it: int if every
+    cell that is not NA is an integer and no cell is NA, float if every such
+    cell is a number, bool if every such cell is True/False, text otherwise.
+    Numbers may be surrounded by whitespace.
+
+    Output:
+    :return: 'int', 'float', 'bool' or 'str' for every column
+    :rtype: list
+    '''
+    # kinds still possible for every column
+    possible = None
+    has_na = None
+    for row in rows:
+        if possible is None:
+            possible = [{'int', 'float', 'bool'} for _ in row]
+            has_na = [False]*len(row)
+        for i,text in enumerate(row):
+            if text in NA_VALUES:
+                has_na[i] = True
+                continue
+            kinds = possible[i]
+            if not kinds:
+                continue
+            stripped = text.strip()
+            if 'int' in kinds and not INT_RE.fullmatch(stripped):
+                kinds.discard('int')
+            if 'float' in kinds and not FLOAT_RE.fullmatch(stripped):
+                kinds.discard('float')
+            if 'bool' in kinds and stripped not in TRUE_VALUES and \
+                stripped not in FALSE_VALUES:
+                kinds.discard('bool')
+    types = []
+    for kinds, na in zip(possible or [], has_na or []):
+        if 'int' in kinds and not na:
+            types.append('int')
+        elif 'float' in kinds:
+            # integers with empty cells, and empty columns, are floats
+            types.append('float')
+        elif 'bool' in kinds:
+            types.append('bool')
+        else:
+            types.append('str')
+    return types
+
+def convert_int(text):
+    return int(text)
+
+def convert_float(text):
+    return None if text in NA_VALUES else float(text)
+
+def convert_bool(text):
+    return None if text in NA_VALUES else text.strip() in TRUE_VALUES
+
+def convert_str(text):
+    return None if text in NA_VALUES else text
+
+# column type -> converter of the cells, see column_types
+CONVERTERS = {'int': convert_int, 'float': convert_float, 'bool': convert_bool,
+    'str': convert_str}
+
+def dedupe_columns(columns):
+    # repeated columns are renamed $x, $x.1, $x.2, as in pandas
+    seen = {}
+    out = []
+    for col in columns:
+        if col in seen:
+            seen[col] += 1
+            col = f'{col}.{seen[col]}'
+        else:
+            seen[col] = 0
+        out.append(col)
+    return out
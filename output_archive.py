@@ -0,0 +1,262 @@
+## Output zip archive written member by member by batch_curation
+
+# -------------------------------------------- file os and other general lib
+import os
+import glob
+import queue
+import shutil
+import threading
+import time
+import zipfile
+
+# chunk size used to stream file contents into the archive
+CHUNK_SIZE = 1024*1024
+
+# file types that are compressed already, stored without deflate by default
+STORE_EXTENSIONS = {'.mat', '.xlsx', '.zip', '.gz', '.bz2', '.xz', '.7z',
+    '.png', '.jpg', '.jpeg', '.gif', '.tif', '.tiff', '.h5'}
+
+# operations queued per shard before the producer waits for the writer
+QUEUE_SIZE = 64
+
+class OutputArchive():
+    def __init__(self, path, compression=zipfile.ZIP_DEFLATED,
+        compresslevel=None, store_ext=STORE_EXTENSIONS):
+        '''
+        Zip archive that samples are streamed into. The archive is written to
+        a temporary file next to path and only moved to path when closed
+        without errors.
+
+        Input:
+        :param path: file name of the output zip file. *.zip
+        :type path: str
+
+        :param compression: zipfile compression method of the members
+        :type compression: int
+
+        :param compresslevel: deflate level 0-9 of the members, zlib default
+            if None
+        :type compresslevel: int or NoneType
+
+        :param store_ext: extensions of the members stored without compression
+        :type store_ext: set
+        '''
+        self.path = path
+        self.part_path = path + '.part'
+        self.compresslevel = compresslevel
+        self.store_ext = {ext.lower() for ext in store_ext}
+        self.zf = zipfile.ZipFile(self.part_path, 'w', compression,
+            compresslevel=compresslevel)
+
+    def compression(self, arcname):
+        if os.path.splitext(arcname)[1].lower() in self.store_ext:
+            return zipfile.ZIP_STORED
+        return self.zf.compression
+
+    def add_folder(self, folder):
+        self.zf.writestr(folder.rstrip('/') + '/', b'')
+
+    def add_bytes(self, arcname, data):
+        self.zf.writestr(arcname, data, self.compression(arcname))
+
+    def add_file(self, arcname, path):
+        self.zf.write(path, arcname, self.compression(arcname))
+
+    def add_fileobj(self, arcname, fileobj, date_time=None):
+        zinfo = zipfile.ZipInfo(arcname, date_time or time.localtime()[:6])
+        zinfo.compress_type = self.compression(arcname)
+        zinfo.external_attr = 0o644 << 16
+        # ZipFile.open only takes the level from the ZipInfo
+        if hasattr(zipfile.ZipInfo, 'compress_level'):
+            zinfo.compress_level = self.compresslevel
+        else:
+            zinfo._compresslevel = self.compresslevel
+        with self.zf.open(zinfo, 'w') as dest:
+            shutil.copyfileobj(fileobj, dest, CHUNK_SIZE)
+
+    def close(self):
+        self.zf.close()
+        os.replace(self.part_path, self.path)
+
+    def abort(self):
+        self.zf.close()
+        os.remove(self.part_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ShardWriter():
+    def __init__(self, path, **archive_options):
+        '''
+        OutputArchive written by its own thread. Operations are queued with
+        submit and run in order, compression releases the GIL so several
+        shards are written concurrently.
+        '''
+        self.path = path
+        self.archive = OutputArchive(path, **archive_options)
+        self.samples = 0
+        self.bytes = 0
+        # time spent writing, for the run profile
+        self.seconds = 0.0
+        self.error = None
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def work(self):
+        while True:
+            op = self.queue.get()
+            if op is None:
+                break
+            # keep draining the queue after an error, the producer sees it on
+            # the next submit
+            if self.error is None:
+                start = time.perf_counter()
+                try:
+                    op(self.archive)
+                except BaseException as e:
+                    self.error = e
+                self.seconds += time.perf_counter() - start
+        if self.error is None:
+            try:
+                self.archive.close()
+            except BaseException as e:
+                self.error = e
+        else:
+            self.archive.abort()
+
+    def submit(self, op):
+        '''
+        Queue op(archive) to run in the writer thread.
+        '''
+        if self.error is not None:
+            raise self.error
+        self.queue.put(op)
+
+    def finish(self):
+        # queue the close of the archive, returns immediately
+        self.queue.put(None)
+
+    def join(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+class ShardedOutput():
+    def __init__(self, output_zip, shards=1, shard_samples=None,
+        shard_size=None, **archive_options):
+        '''
+        Output zip split into shards written concurrently. Samples go round
+        robin to shards open at the same time, a shard is closed and
+        replaced by a new one once it holds shard_samples samples or
+        shard_size bytes. Without shards or limits, the output is a single
+        {output_zip}.zip, otherwise {output_zip}_part000.zip, ...
+
+        Input:
+        :param output_zip: file name of the output without .zip
+        :type output_zip: str
+
+        :param shards: number of shards written at the same time
+        :type shards: int
+
+        :param shard_samples: maximum number of samples per shard
+        :type shard_samples: int or NoneType
+
+        :param shard_size: maximum uncompressed bytes per shard, a sample is
+            never split
+        :type shard_size: int or NoneType
+
+        :param archive_options: compresslevel and store_ext of OutputArchive
+        :type archive_options: dict
+        '''
+        self.output_zip = output_zip
+        self.sharded = shards > 1 or bool(shard_samples) or bool(shard_size)
+        self.shard_samples = shard_samples
+        self.shard_size = shard_size
+        self.archive_options = archive_options
+        # shard writers open at the same time
+        self.slots = [None]*max(1, shards)
+        self.writers = []
+        self.count = 0
+
+    def shard_path(self, index):
+        if not self.sharded:
+            return self.output_zip + '.zip'
+        return f'{self.output_zip}_part{index:03d}.zip'
+
+    def add_sample(self, nbytes, ops):
+        '''
+        Queue the operations writing a sample into its shard and return the
+        file name of the shard.
+
+        Input:
+        :param nbytes: uncompressed size of the sample, in bytes
+        :type nbytes: int
+
+        :param ops: functions called with the OutputArchive of the shard
+        :type ops: list
+        '''
+        slot = self.count % len(self.slots)
+        self.count += 1
+        writer = self.slots[slot]
+        if writer is not None and ((self.shard_samples and
+            writer.samples >= self.shard_samples) or (self.shard_size and
+            writer.bytes and writer.bytes + nbytes > self.shard_size)):
+            # the full shard is closed by its thread in the background
+            writer.finish()
+            writer = None
+        if writer is None:
+            writer = ShardWriter(self.shard_path(len(self.writers)),
+                **self.archive_options)
+            self.writers.append(writer)
+            self.slots[slot] = writer
+        for op in ops:
+            writer.submit(op)
+        writer.samples += 1
+        writer.bytes += nbytes
+        return writer.path
+
+    def close(self):
+        for writer in self.slots:
+            if writer is not None:
+                writer.finish()
+        for writer in self.writers:
+            writer.join()
+
+    def abort(self):
+        for writer in self.writers:
+            # the writer thread drains the queue and removes its part file
+            if writer.error is None:
+                writer.error = Exception('Output aborted.')
+            writer.finish()
+        for writer in self.writers:
+            writer.thread.join()
+
+    def remove_stale(self):
+        '''
+        Remove shards of a previous run of the same output that were not
+        written again, and the single output zip of a previous unsharded run.
+        '''
+        written = {writer.path for writer in self.writers}
+        stale = glob.glob(glob.escape(self.output_zip) + '_part*.zip')
+        if self.sharded and os.path.exists(self.output_zip + '.zip'):
+            stale.append(self.output_zip + '.zip')
+        for path in stale:
+            if path not in written:
+                os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,214 @@
+## Verification of the output zip of batch_curation, reads the sheet XML of
+## every generated master template without openpyxl
+
+# -------------------------------------------- file os and other general lib
+import io
+import re
+import csv
+import math
+import zipfile
+import datetime
+import posixpath
+from html import unescape
+# -------------------------------------------- logging
+import logging
+
+# columns of the per-sample report
+REPORT_COLUMNS = ['sample_id', 'archive', 'result', 'checked_cells', 'issues']
+
+# patterns of the SpreadsheetML parts
+SHEET_RE = re.compile(r'<sheet\b[^>]*?\bname="([^"]*)"[^>]*?\br:id="([^"]*)"')
+REL_RE = re.compile(r'<Relationship\b[^>]*?\bId="([^"]*)"[^>]*?\bTarget="([^"]*)"')
+REL_RE_REVERSED = re.compile(r'<Relationship\b[^>]*?\bTarget="([^"]*)"[^>]*?\bId="([^"]*)"')
+SI_RE = re.compile(r'<si>(.*?)</si>', re.S)
+T_RE = re.compile(r'<t\b[^>]*?>(.*?)</t>|<t\b[^>]*?/>', re.S)
+CELL_RE = re.compile(r'<c\b([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+ATTR_RE = re.compile(r'\b(r|t)="([^"]*)"')
+V_RE = re.compile(r'<v>(.*?)</v>', re.S)
+F_RE = re.compile(r'<f\b[^>]*?>(.*?)</f>', re.S)
+COLUMN_RE = re.compile(r'([A-Z]+)(\d+)')
+
+def column_letter(column):
+    letters = ''
+    while column:
+        column, rest = divmod(column - 1, 26)
+        letters = chr(65 + rest) + letters
+    return letters
+
+def expected_cells(template, sample_mapping, parser_out):
+    '''
+    Cells the templating engine writes for a sample, in the order of
+    CompiledTemplate.render: placeholders first, overwritten by parser_out.
+
+    Output:
+    :return: sheet title -> {cell reference: expected value}
+    :rtype: dict
+    '''
+    expected = {}
+    for title, cells in template.placeholder_cells.items():
+        sheet = expected.setdefault(title, {})
+        for r,c,placeholder in cells:
+            sheet[f'{column_letter(c)}{r}'] = sample_mapping[placeholder]
+        headers = template.row_headers[title]
+        for row_header, values in parser_out.items():
+            for r in headers.get(row_header, ()):
+                for i,v in enumerate(values):
+                    if v:
+                        sheet[f'{column_letter(i+2)}{r}'] = v
+    return expected
+
+def read_workbook(data):
+    '''
+    Values of the cells of an xlsx file given as bytes.
+
+    Output:
+    :return: sheet title -> {cell reference: (type, value, formula)}, value
+        is the text of <v> or of the inline or shared string
+    :rtype: dict
+    '''
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        names = set(zf.namelist())
+        workbook = zf.read('xl/workbook.xml').decode('utf-8')
+        rels = zf.read('xl/_rels/workbook.xml.rels').decode('utf-8')
+        targets = dict(REL_RE.findall(rels))
+        targets.update((rid, target)
+            for target, rid in REL_RE_REVERSED.findall(rels))
+        strings = []
+        if 'xl/sharedStrings.xml' in names:
+            for si in SI_RE.findall(zf.read('xl/sharedStrings.xml').decode(
+                'utf-8')):
+                # rich text runs are joined
+                strings.append(''.join(unescape(t) for t in T_RE.findall(si)))
+        sheets = {}
+        for title, rid in SHEET_RE.findall(workbook):
+            target = targets.get(rid, '')
+            path = target.lstrip('/') if target.startswith('/') else \
+                posixpath.normpath(posixpath.join('xl', target))
+            if path not in names:
+                continue
+            sheets[unescape(title)] = read_sheet(zf.read(path).decode('utf-8'),
+                strings)
+    return sheets
+
+def read_sheet(xml, strings):
+    cells = {}
+    for attrs, body in CELL_RE.findall(xml):
+        attrs = dict(ATTR_RE.findall(attrs))
+        ref = attrs.get('r')
+        if ref is None:
+            continue
+        cell_type = attrs.get('t', 'n')
+        value = None
+        formula = None
+        if body:
+            if cell_type == 'inlineStr':
+                value = ''.join(unescape(t) for t in T_RE.findall(body))
+            else:
+                v = V_RE.search(body)
+                value = unescape(v.group(1)) if v else None
+                if cell_type == 's' and value not in (None, ''):
+                    value = strings[int(value)]
+            f = F_RE.search(body)
+            formula = unescape(f.group(1)) if f else None
+        cells[ref] = (cell_type, value, formula)
+    return cells
+
+def cell_matches(cell, expected):
+    # cell as read by read_sheet, expected as assigned by the engine
+    cell_type, value, formula = cell or ('n', None, None)
+    # empty text is written as an empty cell by the xml engine and read
+    # back as None, as by the mapping readers
+    if expected is None or expected == '' or (isinstance(expected, float) and
+        math.isnan(expected)):
+        return value in (None, '') and formula is None
+    if isinstance(expected, str) and expected.startswith('=') and \
+        len(expected) > 1:
+        return formula == expected[1:]
+    if isinstance(expected, bool):
+        return cell_type == 'b' and value == ('1' if expected else '0')
+    if isinstance(expected, (datetime.date, datetime.time,
+        datetime.timedelta)):
+        # stored as a number in the date system of the workbook
+        return value not in (None, '')
+    if isinstance(expected, str):
+        return cell_type in ('s', 'inlineStr', 'str') and value == expected
+    try:
+        return math.isclose(float(value), float(expected), rel_tol=1e-12)
+    except (TypeError, ValueError):
+        return False
+
+def check_sample(sample_id, zf, members, workbook_name, files, expected,
+    placeholders):
+    '''
+    Check a sample folder of an output zip.
+
+    Input:
+    :param zf: output zip holding the sample
+    :type zf: zipfile.ZipFile
+
+    :param members: ZipInfo of the sample folder
+    :type members: list
+
+    :param files: names of the appendix files referenced by the sample
+    :type files: list
+
+    :param expected: see expected_cells
+    :type expected: dict
+
+    :param placeholders: placeholders of the master template, none of them
+        may be left in the workbook
+    :type placeholders: set
+
+    Output:
+    :return: issues found and number of cells checked
+    :rtype: tuple(list, int)
+    '''
+    issues = []
+    names = {info.filename for info in members}
+    for file in files:
+        if f'{sample_id}/{file}' not in names:
+            issues.append(f'missing appendix file {file}')
+    workbook = f'{sample_id}/{workbook_name}'
+    if workbook not in names:
+        issues.append(f'missing {workbook_name}')
+        return issues, 0
+    try:
+        sheets = read_workbook(zf.read(workbook))
+    except (KeyError, ValueError, zipfile.BadZipFile) as e:
+        issues.append(f'unreadable {workbook_name}: {e}')
+        return issues, 0
+    checked = 0
+    for title, cells in expected.items():
+        if title not in sheets:
+            issues.append(f'missing sheet {title}')
+            continue
+        sheet = sheets[title]
+        for ref, value in cells.items():
+            checked += 1
+            if not cell_matches(sheet.get(ref), value):
+                cell_type, found, formula = sheet.get(ref, (None, None, None))
+                found = '=' + formula if formula else found
+                issues.append(f"'{title}'!{ref} is {found!r}, expected {value!r}")
+        for ref, (cell_type, value, formula) in sheet.items():
+            # leftover placeholders outside the checked cells, column A holds
+            # the row headers
+            if value in placeholders and ref not in cells and \
+                COLUMN_RE.match(ref).group(1) != 'A':
+                issues.append(f"'{title}'!{ref} still holds {value}")
+    return issues, checked
+
+def write_report(path, rows):
+    '''
+    Write the per-sample results as csv and return the number of failed
+    samples.
+    '''
+    failed = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(REPORT_COLUMNS)
+        for sample_id, archive, issues, checked in rows:
+            failed += bool(issues)
+            writer.writerow([sample_id, archive, 'fail' if issues else 'pass',
+                checked, '; '.join(issues)])
+    logging.info(f'Verification report saved as {path}.')
+    return failed
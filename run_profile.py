@@ -0,0 +1,140 @@
+## Per-stage timing of batch_curation runs, saved as a JSON run report
+
+# -------------------------------------------- file os and other general lib
+import os
+import json
+import time
+import platform
+import threading
+from contextlib import contextmanager
+# -------------------------------------------- logging
+import logging
+
+class RunProfile():
+    def __init__(self, enabled=True):
+        '''
+        Collect wall time, bytes moved and cache counters per stage, for every
+        sample and for the whole run. Does nothing if not enabled.
+
+        Input:
+        :param enabled: record timings if True
+        :type enabled: bool
+        '''
+        self.enabled = enabled
+        # stage name -> {'seconds', 'calls', 'bytes'}
+        self.stages = {}
+        # counter name -> value, summed over the samples
+        self.counters = {}
+        # sample id -> {'seconds', 'stages', 'counters'}
+        self.samples = {}
+        # record of the sample being processed in this process
+        self.current = None
+        # stages are timed by the I/O threads too
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, nbytes=0):
+        '''
+        Time the body of the with statement as stage name.
+        '''
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, nbytes)
+
+    def add(self, name, seconds, nbytes=0):
+        if not self.enabled:
+            return
+        self._add(self.stages, name, seconds, 1, nbytes)
+        if self.current is not None:
+            self._add(self.current['stages'], name, seconds, 1, nbytes)
+
+    def _add(self, stages, name, seconds, calls, nbytes):
+        with self.lock:
+            stage = stages.setdefault(name, {'seconds': 0.0, 'calls': 0,
+                'bytes': 0})
+            stage['seconds'] += seconds
+            stage['calls'] += calls
+            stage['bytes'] += nbytes
+
+    @contextmanager
+    def sample(self, sample_id, counters=None):
+        '''
+        Record the stages timed in the body of the with statement as the
+        stages of sample_id.
+
+        Input:
+        :param counters: function returning the current value of the cache
+            counters, the change during the sample is recorded
+        :type counters: callable or NoneType
+        '''
+        if not self.enabled:
+            yield
+            return
+        before = counters() if counters else {}
+        self.current = {'seconds': 0.0, 'stages': {}, 'counters': {}}
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record, self.current = self.current, None
+            record['seconds'] = time.perf_counter() - start
+            if counters:
+                for name, value in counters().items():
+                    record['counters'][name] = value - before.get(name, 0)
+                    self.count(name, record['counters'][name])
+            self.samples[str(sample_id)] = record
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def pop_sample(self, sample_id):
+        return self.samples.pop(str(sample_id), None)
+
+    def merge_sample(self, sample_id, record):
+        '''
+        Add the record of a sample processed in a worker process.
+        '''
+        if not self.enabled or record is None:
+            return
+        self.samples[str(sample_id)] = record
+        for name, stage in record['stages'].items():
+            self._add(self.stages, name, stage['seconds'], stage['calls'],
+                stage['bytes'])
+        for name, value in record['counters'].items():
+            self.count(name, value)
+
+    def report(self, meta=None):
+        stages = {}
+        for name, stage in self.stages.items():
+            stage = dict(stage)
+            stage['mb_per_s'] = stage['bytes']/1024/1024/stage['seconds'] \
+                if stage['seconds'] and stage['bytes'] else None
+            stages[name] = stage
+        return {
+            'meta': dict(meta or {}, python=platform.python_version(),
+                platform=platform.platform(), cpu_count=os.cpu_count()),
+            'stages': stages,
+            'counters': self.counters,
+            'samples': self.samples,
+        }
+
+    def save(self, path, meta=None):
+        with open(path, 'w') as f:
+            json.dump(self.report(meta), f, indent=1)
+        logging.info(f'Run profile saved as {path}.')
@@ -0,0 +1,489 @@
+## Compiled master template used by batch_curation
+
+# -------------------------------------------- file os and other general lib
+import os
+import io
+import copy
+import re
+import math
+import time
+import zipfile
+import posixpath
+# -------------------------------------------- for data I/O
+import numpy
+import openpyxl
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.compat.numbers import NUMERIC_TYPES
+from openpyxl.utils.cell import column_index_from_string, get_column_letter
+from openpyxl.utils.exceptions import IllegalCharacterError
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+from html import unescape
+# -------------------------------------------- logging
+import logging
+
+# worksheets that never hold placeholders or inp_parser targets
+IGNORE_SHEETS = {'legend','4. Characterization Methods',
+    'Characterization Methods to Add','Dropdown menu choices'}
+
+class CompiledTemplate():
+    # unpickling the workbook is as slow as loading it, worker processes load
+    # their own copy, see batch_curation.__getstate__
+    send_to_workers = False
+
+    def __init__(self, master_template, ignore_sheets=IGNORE_SHEETS):
+        '''
+        Load the master template once and index the cells that change among
+        the samples, so each sample only touches those cells.
+
+        Input:
+        :param master_template: path of the master template. *.xlsx
+        :type master_template: str
+
+        :param ignore_sheets: titles of the worksheets to leave untouched
+        :type ignore_sheets: set
+        '''
+        self.master_template = master_template
+        self.ignore_sheets = ignore_sheets
+        self.wb = openpyxl.load_workbook(master_template)
+        # sheet title -> [(row, column, placeholder), ...]
+        self.placeholder_cells = {}
+        # sheet title -> {col A value: [row, ...]}
+        self.row_headers = {}
+        self.compile()
+
+    def compile(self):
+        for sheet in self.wb:
+            # ignore irrelevant worksheets
+            if sheet.title in self.ignore_sheets:
+                continue
+            cells = []
+            headers = {}
+            for row in sheet.iter_rows():
+                # col 1 is always property names, used by inp_parser output
+                if row[0].value is not None:
+                    headers.setdefault(row[0].value, []).append(row[0].row)
+                # placeholders only live in col 2 and after
+                for cell in row[1:]:
+                    if isinstance(cell.value,str) and cell.value.startswith('$'):
+                        cells.append((cell.row, cell.column, cell.value))
+            self.placeholder_cells[sheet.title] = cells
+            self.row_headers[sheet.title] = headers
+
+    @property
+    def placeholders(self):
+        '''
+        Set of all special placeholders used in the master template.
+        '''
+        return {ph for cells in self.placeholder_cells.values()
+            for _,_,ph in cells}
+
+    def render(self, sample_mapping, parser_out, dest, profile=None):
+        '''
+        Fill the placeholders and inp_parser output of one sample and save the
+        workbook to dest. The compiled workbook is restored afterwards.
+
+        Input:
+        :param sample_mapping: a row of the mapping
+        :type sample_mapping: mapping_reader.MappingRow
+
+        :param parser_out: output of inp_parser.Parser.to_dict()
+        :type parser_out: dict
+
+        :param dest: file name or file-like object to save the workbook to
+        :type dest: str or file
+
+        :param profile: times the cell update and the workbook save
+        :type profile: run_profile.RunProfile or NoneType
+        '''
+        # (sheet title, row, column) -> (original value, cell existed)
+        touched = {}
+        start = time.perf_counter()
+        try:
+            for title, cells in self.placeholder_cells.items():
+                sheet = self.wb[title]
+                for r,c,placeholder in cells:
+                    cell = self._touch(sheet, r, c, touched)
+                    cell.value = sample_mapping[placeholder]
+                # update info parsed from inp files
+                headers = self.row_headers[title]
+                for row_header, values in parser_out.items():
+                    # example of parser_out[row_header]:
+                    # ['inserted by inp_parser', 'CPE4R']
+                    for r in headers.get(row_header, ()):
+                        for i,v in enumerate(values):
+                            if v:
+                                cell = self._touch(sheet, r, i+2, touched)
+                                if cell.value is not None:
+                                    print(f'Warning: {cell} with value {cell.value} overwritten as {v}')
+                                    logging.warning(f'{cell} with value {cell.value} overwritten as {v}')
+                                cell.value = v
+            if profile is not None:
+                profile.add('cell_update', time.perf_counter() - start)
+                start = time.perf_counter()
+            self.wb.save(dest)
+            if profile is not None:
+                profile.add('workbook_save', time.perf_counter() - start,
+                    dest.tell() if hasattr(dest, 'tell') else
+                    os.path.getsize(dest))
+        finally:
+            self._restore(touched)
+
+    def _touch(self, sheet, row, column, touched):
+        key = (sheet.title, row, column)
+        if key not in touched:
+            # openpyxl creates missing cells on access, remember whether the
+            # cell was part of the template so it can be dropped again
+            existed = (row, column) in sheet._cells
+            cell = sheet.cell(row=row, column=column)
+            # assigning dates and times also changes the type and the number
+            # format of the cell
+            touched[key] = (cell._value, cell.data_type, copy.copy(cell._style),
+                existed)
+            return cell
+        return sheet.cell(row=row, column=column)
+
+    def _restore(self, touched):
+        for (title, row, column), (value, data_type, style, existed) in \
+            touched.items():
+            sheet = self.wb[title]
+            if existed:
+                cell = sheet.cell(row=row, column=column)
+                cell._value = value
+                cell.data_type = data_type
+                cell._style = style
+            else:
+                del sheet._cells[(row, column)]
+
+
+## Templating straight on the XML parts of the .xlsx file
+# namespaces of the workbook parts
+MAIN_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+PKG_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+ROW_RE = re.compile(rb'<row\b([^>]*?)(/>|>(.*?)</row>)', re.S)
+CELL_RE = re.compile(rb'<c\b([^>]*?)(/>|>(.*?)</c>)', re.S)
+ATTR_RE = re.compile(rb'([\w:]+)="([^"]*)"')
+SPANS_RE = re.compile(rb'\sspans="[^"]*"')
+DIMENSION_RE = re.compile(rb'(<dimension\b[^>]*?ref=")([^"]*)(")')
+
+class UnsupportedValue(Exception):
+    pass
+
+class XmlRow():
+    # a row of the sheetData, original bytes and cells by column
+    __slots__ = ('r', 'open', 'close', 'raw', 'cells')
+    def __init__(self, r, open_tag, close_tag, raw):
+        self.r = r
+        self.open = open_tag
+        self.close = close_tag
+        self.raw = raw
+        # column -> (original bytes, attributes, value)
+        self.cells = {}
+
+class XmlTemplate():
+    # the compiled parts are pickled into the worker processes
+    send_to_workers = True
+
+    def __init__(self, master_template, ignore_sheets=IGNORE_SHEETS):
+        '''
+        Alternative to CompiledTemplate that never loads the workbook in
+        openpyxl. The sheet XML and the shared strings are indexed once, every
+        sample copies the unchanged parts byte for byte and only rewrites the
+        rows holding changed cells. Values are written the way openpyxl writes
+        them, samples with values openpyxl would style (e.g. dates) are
+        rendered by CompiledTemplate instead.
+
+        Input:
+        :param master_template: path of the master template. *.xlsx
+        :type master_template: str
+
+        :param ignore_sheets: titles of the worksheets to leave untouched
+        :type ignore_sheets: set
+        '''
+        self.master_template = master_template
+        self.ignore_sheets = ignore_sheets
+        # sheet title -> [(row, column, placeholder), ...]
+        self.placeholder_cells = {}
+        # sheet title -> {col A value: [row, ...]}
+        self.row_headers = {}
+        # sheet title -> (part name, [bytes or XmlRow, ...], {row: XmlRow},
+        # max column of the dimension)
+        self.sheets = {}
+        # CompiledTemplate used for unsupported values, loaded when needed
+        self.fallback = None
+        self.compile()
+
+    def __getstate__(self):
+        # the fallback workbook is loaded again when needed
+        state = self.__dict__.copy()
+        state['fallback'] = None
+        return state
+
+    def compile(self):
+        with zipfile.ZipFile(self.master_template) as zf:
+            infos = zf.infolist()
+            shared_strings = self.read_shared_strings(zf)
+            parts = self.sheet_parts(zf)
+            for title, part in parts.items():
+                if title in self.ignore_sheets:
+                    continue
+                self.compile_sheet(title, part, zf.read(part), shared_strings)
+            # openpyxl never writes the calculation chain, it refers to
+            # formula cells that may be overwritten
+            calc_chain = [info.filename for info in infos
+                if info.filename.lower().endswith('calcchain.xml')]
+            # unchanged parts are zipped once, samples append their sheets
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as out:
+                dynamic = {part for part,_,_,_ in self.sheets.values()}
+                for info in infos:
+                    if info.filename in dynamic or info.filename in calc_chain:
+                        continue
+                    data = zf.read(info)
+                    if calc_chain and info.filename in ('[Content_Types].xml',
+                        'xl/_rels/workbook.xml.rels'):
+                        data = re.sub(rb'<(Override|Relationship)\b[^>]*?calcChain[^>]*?/>',
+                            b'', data, flags=re.I)
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    out.writestr(info, data)
+            self.prefix = buffer.getvalue()
+            self.infos = {info.filename: info for info in infos}
+
+    def read_shared_strings(self, zf):
+        try:
+            data = zf.read('xl/sharedStrings.xml')
+        except KeyError:
+            return []
+        strings = []
+        for si in ElementTree.fromstring(data).iter(MAIN_NS + 'si'):
+            # plain text, or the runs of rich text, phonetic runs are skipped
+            t = si.find(MAIN_NS + 't')
+            if t is not None:
+                strings.append(t.text or '')
+            else:
+                strings.append(''.join(r.findtext(MAIN_NS + 't') or ''
+                    for r in si.iter(MAIN_NS + 'r')))
+        return strings
+
+    def sheet_parts(self, zf):
+        # worksheet title -> part name, in the order of the workbook
+        rels = ElementTree.fromstring(zf.read('xl/_rels/workbook.xml.rels'))
+        targets = {}
+        for rel in rels.iter(PKG_REL_NS + 'Relationship'):
+            if rel.get('Type', '').endswith('/worksheet'):
+                target = rel.get('Target')
+                target = target[1:] if target.startswith('/') else \
+                    posixpath.normpath(posixpath.join('xl', target))
+                targets[rel.get('Id')] = target
+        parts = {}
+        workbook = ElementTree.fromstring(zf.read('xl/workbook.xml'))
+        for sheet in workbook.iter(MAIN_NS + 'sheet'):
+            if sheet.get(REL_NS + 'id') in targets:
+                parts[sheet.get('name')] = targets[sheet.get(REL_NS + 'id')]
+        return parts
+
+    def compile_sheet(self, title, part, data, shared_strings):
+        start = re.search(rb'<sheetData\b[^>]*?(/?)>', data)
+        if start is None or start.group(1):
+            # no cells, nothing to fill
+            return
+        end = data.index(b'</sheetData>', start.end())
+        chunks = []
+        rows = {}
+        cells = []
+        headers = {}
+        pos = start.end()
+        r = 0
+        for m in ROW_RE.finditer(data, start.end(), end):
+            chunks.append(data[pos:m.start()])
+            attrs = dict(ATTR_RE.findall(m.group(1)))
+            # row and cell references are optional, they follow the previous
+            r = int(attrs[b'r']) if b'r' in attrs else r + 1
+            if m.group(3) is None:
+                row = XmlRow(r, data[m.start():m.end()-2] + b'>', b'</row>',
+                    m.group(0))
+            else:
+                row = XmlRow(r, data[m.start():m.start(3)], b'</row>',
+                    m.group(0))
+                c = 0
+                for cm in CELL_RE.finditer(m.group(3)):
+                    cell_attrs = dict(ATTR_RE.findall(cm.group(1)))
+                    if b'r' in cell_attrs:
+                        c = column_index_from_string(
+                            cell_attrs[b'r'].decode().rstrip('0123456789'))
+                    else:
+                        c += 1
+                    value = self.decode(cell_attrs, cm.group(3), shared_strings)
+                    row.cells[c] = (cm.group(0), cell_attrs, value)
+                    # col 1 is always property names, used by inp_parser output
+                    if c == 1 and value is not None:
+                        headers.setdefault(value, []).append(r)
+                    # placeholders only live in col 2 and after
+                    elif c > 1 and isinstance(value,str) and value.startswith('$'):
+                        cells.append((r, c, value))
+            rows[r] = row
+            chunks.append(row)
+            pos = m.end()
+        chunks.append(data[pos:end])
+        chunks.insert(0, data[:start.end()])
+        chunks.append(data[end:])
+        dimension = DIMENSION_RE.search(chunks[0])
+        max_column = 0
+        if dimension is not None:
+            ref = dimension.group(2).decode().split(':')[-1]
+            max_column = column_index_from_string(ref.rstrip('0123456789'))
+        self.placeholder_cells[title] = cells
+        self.row_headers[title] = headers
+        self.sheets[title] = (part, chunks, rows, max_column)
+
+    def decode(self, attrs, body, shared_strings):
+        '''
+        Value of a cell as read by openpyxl.
+        '''
+        if not body:
+            return None
+        formula = re.search(rb'<f\b[^>]*?(?:/>|>(.*?)</f>)', body, re.S)
+        if formula is not None and formula.group(1):
+            return '=' + unescape(formula.group(1).decode())
+        cell_type = attrs.get(b't', b'n')
+        if cell_type == b'inlineStr':
+            return ''.join(unescape(t.decode()) for t in
+                re.findall(rb'<t\b[^>]*>(.*?)</t>', body, re.S))
+        v = re.search(rb'<v>(.*?)</v>', body, re.S)
+        if v is None:
+            return None
+        v = unescape(v.group(1).decode())
+        if cell_type == b's':
+            return shared_strings[int(v)]
+        if cell_type == b'b':
+            return v == '1'
+        if cell_type in (b'str', b'e'):
+            return v
+        try:
+            return int(v)
+        except ValueError:
+            return float(v)
+
+    @property
+    def placeholders(self):
+        '''
+        Set of all special placeholders used in the master template.
+        '''
+        return {ph for cells in self.placeholder_cells.values()
+            for _,_,ph in cells}
+
+    def render(self, sample_mapping, parser_out, dest, profile=None):
+        '''
+        Fill the placeholders and inp_parser output of one sample and save the
+        workbook to dest. Same signature as CompiledTemplate.render.
+        '''
+        start = time.perf_counter()
+        try:
+            sheets = self.fill(sample_mapping, parser_out)
+        except UnsupportedValue:
+            if self.fallback is None:
+                self.fallback = CompiledTemplate(self.master_template,
+                    self.ignore_sheets)
+            self.fallback.render(sample_mapping, parser_out, dest, profile)
+            return
+        if profile is not None:
+            profile.add('cell_update', time.perf_counter() - start)
+            start = time.perf_counter()
+        buffer = io.BytesIO()
+        buffer.write(self.prefix)
+        with zipfile.ZipFile(buffer, 'a', zipfile.ZIP_DEFLATED) as zf:
+            for part, data in sheets:
+                zf.writestr(self.infos[part], data)
+        if hasattr(dest, 'write'):
+            dest.write(buffer.getbuffer())
+        else:
+            with open(dest, 'wb') as f:
+                f.write(buffer.getbuffer())
+        if profile is not None:
+            profile.add('workbook_save', time.perf_counter() - start,
+                len(buffer.getbuffer()))
+
+    def fill(self, sample_mapping, parser_out):
+        # XML of every sheet with the placeholders and inp_parser output
+        sheets = []
+        for title, (part, chunks, rows, max_column) in self.sheets.items():
+            # row -> {column: value}
+            changed = {}
+            for r,c,placeholder in self.placeholder_cells[title]:
+                changed.setdefault(r, {})[c] = sample_mapping[placeholder]
+            # update info parsed from inp files
+            headers = self.row_headers[title]
+            for row_header, values in parser_out.items():
+                # example of parser_out[row_header]:
+                # ['inserted by inp_parser', 'CPE4R']
+                for r in headers.get(row_header, ()):
+                    for i,v in enumerate(values):
+                        if v:
+                            row = changed.setdefault(r, {})
+                            value = row[i+2] if i+2 in row else \
+                                rows[r].cells.get(i+2, (None, None, None))[2]
+                            if value is not None:
+                                ref = f'{get_column_letter(i+2)}{r}'
+                                print(f"Warning: <Cell '{title}'.{ref}> with value {value} overwritten as {v}")
+                                logging.warning(f"<Cell '{title}'.{ref}> with value {value} overwritten as {v}")
+                            row[i+2] = v
+            chunks = list(chunks)
+            new_max = max_column
+            for i,chunk in enumerate(chunks):
+                if isinstance(chunk, XmlRow):
+                    if chunk.r in changed:
+                        chunks[i] = self.render_row(chunk, changed[chunk.r])
+                        new_max = max(new_max, max(changed[chunk.r]))
+                    else:
+                        chunks[i] = chunk.raw
+            if new_max > max_column:
+                # cells were added on the right of the used range
+                chunks[0] = DIMENSION_RE.sub(lambda m: m.group(1) +
+                    re.sub(rb'[A-Z]+(\d+)$', get_column_letter(new_max).encode()
+                    + rb'\1', m.group(2)) + m.group(3), chunks[0])
+            sheets.append((part, b''.join(chunks)))
+        return sheets
+
+    def render_row(self, row, values):
+        # spans are an optional hint, dropped as they may no longer hold
+        out = [SPANS_RE.sub(b'', row.open)]
+        for c in sorted(set(row.cells) | set(values)):
+            if c in values:
+                style = row.cells[c][1].get(b's') if c in row.cells else None
+                out.append(self.cell_xml(f'{get_column_letter(c)}{row.r}',
+                    style, values[c]))
+            else:
+                out.append(row.cells[c][0])
+        out.append(row.close)
+        return b''.join(out)
+
+    def cell_xml(self, ref, style, value):
+        '''
+        XML of a cell holding value, written as by openpyxl.
+        '''
+        attrs = f'r="{ref}"'
+        if style is not None:
+            attrs += f' s="{style.decode()}"'
+        if value is None:
+            return f'<c {attrs}/>'.encode()
+        if isinstance(value, bool) or isinstance(value, numpy.bool_):
+            return f'<c {attrs} t="b"><v>{int(value)}</v></c>'.encode()
+        if isinstance(value, NUMERIC_TYPES):
+            if math.isnan(value) or math.isinf(value):
+                return f'<c {attrs} t="n"><v></v></c>'.encode()
+            return f'<c {attrs} t="n"><v>{"%.16g" % value}</v></c>'.encode()
+        if isinstance(value, str):
+            if ILLEGAL_CHARACTERS_RE.search(value):
+                raise IllegalCharacterError()
+            if value.startswith('=') and len(value) > 1:
+                return f'<c {attrs}><f>{escape(value[1:])}</f><v></v></c>'.encode()
+            if not value:
+                return f'<c {attrs} t="inlineStr"/>'.encode()
+            space = ' xml:space="preserve"' if value != value.strip() else ''
+            return f'<c {attrs} t="inlineStr"><is><t{space}>{escape(value)}</t></is></c>'.encode()
+        raise UnsupportedValue(value)
+
+# templating engines by name, see batch_curation --engine
+ENGINES = {'openpyxl': CompiledTemplate, 'xml': XmlTemplate}
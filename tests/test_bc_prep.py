@@ -0,0 +1,33 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def bc_prep(tmp_path, monkeypatch):
+    # bc_prep logs into bc_prep_log.log in the current directory
+    monkeypatch.chdir(tmp_path)
+    import bc_prep
+    return bc_prep
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 1024])
+def test_iter_json_items_numbers_cut_by_the_buffer(bc_prep, tmp_path,
+    chunk_size):
+    data = {'a': 1e5, 'b': 123.25, 'c': -1e-3, 'd': 7, 'e': {'f': [1.5, 2]},
+        'g': 'text', 'h': 10}
+    path = tmp_path / 'samples.json'
+    path.write_text(json.dumps(data))
+    items = list(bc_prep.iter_json_items(str(path), chunk_size=chunk_size))
+    assert items == list(data.items())
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4])
+def test_iter_json_items_whitespace_and_empty(bc_prep, tmp_path, chunk_size):
+    path = tmp_path / 'samples.json'
+    path.write_text(' {\n "a" : 1.5e+2 ,\n "b":2 }\n')
+    assert list(bc_prep.iter_json_items(str(path), chunk_size=chunk_size)) \
+        == [('a', 150.0), ('b', 2)]
+    path.write_text('{}')
+    assert list(bc_prep.iter_json_items(str(path), chunk_size=chunk_size)) \
+        == []